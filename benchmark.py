@@ -0,0 +1,95 @@
+import argparse
+import os
+import time
+import tracemalloc
+
+# Benchmarks the search paths against the offline Places fake, so they cost
+# no quota and are repeatable:
+#   python benchmark.py --city paris --radius 1500 --fetch-all-pages
+#   PLACES_BACKEND=new python benchmark.py --city paris
+# The fake and an empty cache have to be configured before the app modules
+# are imported.
+os.environ.setdefault('PLACES_FAKE_API', '1')
+os.environ['PLACES_CACHE_PATH'] = ''
+os.environ.setdefault('GOOGLE_MAPS_API_KEY', 'benchmark')
+os.environ.setdefault('PLACES_TRACE_LOG_LEVEL', '')
+# Measure the search itself, not the process-wide rate limit
+os.environ.setdefault('PLACES_RATE_LIMIT', '0')
+
+from http_client import latency_stats  # noqa: E402
+from places_api import fetch_place_details  # noqa: E402
+from places_backends import nearby_backend  # noqa: E402
+from search import MAIN_PLACE_TYPES, build_queries, calculate_grid_points, run_search  # noqa: E402
+
+
+def scenarios(center, radius, place_type):
+    # (name, queries) for the app's single-type, grid and typeless searches
+    return [
+        ('single', build_queries([center], radius, [place_type])),
+        ('grid', build_queries(calculate_grid_points(center, radius), radius, [place_type])),
+        ('typeless', build_queries([center], radius, MAIN_PLACE_TYPES)),
+        ('typeless grid', build_queries(calculate_grid_points(center, radius), radius, MAIN_PLACE_TYPES)),
+    ]
+
+
+def upstream_totals():
+    # (requests sent, response bytes, parse seconds) across endpoints so far
+    stats = latency_stats().values()
+    return (
+        sum(endpoint['calls'] + endpoint['retries'] for endpoint in stats),
+        sum(endpoint['bytes'] for endpoint in stats),
+        sum(endpoint['parse_seconds'] for endpoint in stats),
+    )
+
+
+def run_scenario(queries, fetch_all_pages):
+    calls_before, bytes_before, parse_before = upstream_totals()
+    tracemalloc.start()
+    started = time.perf_counter()
+    places, errors = run_search(queries, fetch_all_pages=fetch_all_pages)
+    wall = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    calls_after, bytes_after, parse_after = upstream_totals()
+    return {
+        'queries': len(queries),
+        'places': len(places),
+        'errors': len(errors),
+        'wall_seconds': wall,
+        'calls': calls_after - calls_before,
+        'bytes': bytes_after - bytes_before,
+        'parse_seconds': parse_after - parse_before,
+        'peak_memory': peak,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the Places search paths against the offline fake.")
+    parser.add_argument('--city', default='paris')
+    parser.add_argument('--radius', type=int, default=1000)
+    parser.add_argument('--place-type', default='restaurant')
+    parser.add_argument('--fetch-all-pages', action='store_true')
+    parser.add_argument('--repeat', type=int, default=1, help="Runs per scenario; the best wall time is reported")
+    args = parser.parse_args()
+
+    details = fetch_place_details(args.city)
+    if not details:
+        parser.error(f"City not found: {args.city}")
+    location = details['geometry']['location']
+    center = [location['lat'], location['lng']]
+
+    print(f"Places backend: {nearby_backend.name} ({nearby_backend.endpoint})")
+    print(f"{'scenario':<14} {'queries':>7} {'places':>7} {'errors':>6} {'wall s':>8} "
+          f"{'calls':>6} {'KB':>8} {'KB/call':>8} {'parse ms/call':>13} {'peak MB':>8}")
+    for name, queries in scenarios(center, args.radius, args.place_type):
+        runs = [run_scenario(queries, args.fetch_all_pages) for _ in range(args.repeat)]
+        best = min(runs, key=lambda run: run['wall_seconds'])
+        print(f"{name:<14} {best['queries']:>7} {best['places']:>7} {best['errors']:>6} "
+              f"{best['wall_seconds']:>8.2f} {best['calls']:>6} {best['bytes'] / 1024:>8.0f} "
+              f"{best['bytes'] / 1024 / max(1, best['calls']):>8.1f} "
+              f"{best['parse_seconds'] * 1000 / max(1, best['calls']):>13.3f} "
+              f"{best['peak_memory'] / 2 ** 20:>8.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,180 @@
+import argparse
+import json
+import multiprocessing
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from export import EXPORT_FORMATS
+from ranking import SCORE_COLUMNS
+
+# Headless "most reviewed places" sweep over a list of cities:
+#   python city_sweep.py cities.txt --output sweep --workers 4
+# Each city is geocoded, searched (grid and typeless by default), deduped
+# and ranked in a worker process, then written as its own partition of a
+# Parquet dataset (sweep/city=<slug>/part-0.parquet), or of GeoJSON/CSV
+# files with --format. Finished cities are appended to a checkpoint, so an
+# interrupted sweep picks up where it stopped when run again. export.py
+# turns a Parquet sweep into one GeoJSON or CSV file.
+
+
+def city_slug(city):
+    return re.sub(r'[^a-z0-9]+', '-', city.lower()).strip('-')
+
+
+def read_checkpoint(path):
+    # {city: record} of the cities already written
+    done = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    if record['status'] == 'ok':
+                        done[record['city']] = record
+    return done
+
+
+def sweep_city(city, options):
+    # Geocode, search, dedupe and rank one city and write its partition.
+    # Runs in a worker process; returns a checkpoint record.
+    import pyarrow as pa
+
+    from coverage_planner import plan_hex_coverage
+    from export import export_table
+    from http_client import latency_stats
+    from places_api import fetch_place_details
+    from result_store import PlaceTable
+    from search import CallBudget, build_queries, calculate_grid_points, run_search
+
+    def upstream_calls():
+        return sum(stats['calls'] + stats['retries'] for stats in latency_stats().values())
+
+    started = time.perf_counter()
+    calls_before = upstream_calls()
+    record = {'city': city, 'slug': city_slug(city)}
+    details = fetch_place_details(city)
+    if not details:
+        return {**record, 'status': 'failed', 'error': 'city not found',
+                'calls': upstream_calls() - calls_before, 'seconds': time.perf_counter() - started}
+    location = details['geometry']['location']
+    center = [location['lat'], location['lng']]
+
+    radius = options['radius']
+    if options['pattern'] == 'hex':
+        plan = plan_hex_coverage(center, radius, options['cell_radius'])
+        points, radius = plan['points'], round(plan['cell_radius'])
+    elif options['pattern'] == 'grid':
+        points = calculate_grid_points(center, radius)
+    else:
+        points = [center]
+    budget = CallBudget(options['call_budget'])
+    queries = budget.fit(build_queries(points, radius, options['place_types']), center)
+    places, errors = run_search(queries, fetch_all_pages=options['fetch_all_pages'], budget=budget)
+
+    table = PlaceTable.from_places(places)
+    ranked = table.top_k(options['top_k'] or len(table), options['rank_by'])
+    output = ranked.table.append_column('rank', pa.array(range(1, len(ranked) + 1), pa.int32()))
+    partition = os.path.join(options['output'], f"city={record['slug']}")
+    os.makedirs(partition, exist_ok=True)
+    # Streamed under a temporary name first, so a killed worker never
+    # leaves a partial file that looks complete
+    filename = 'part-0' + EXPORT_FORMATS[options['format']][0]
+    temporary = os.path.join(partition, f".{filename}.tmp")
+    export_table(output, options['format'], temporary)
+    os.replace(temporary, os.path.join(partition, filename))
+
+    return {
+        **record,
+        'status': 'ok',
+        'center': center,
+        'queries': len(queries),
+        'places': len(places),
+        'written': len(output),
+        'errors': len(errors),
+        'calls': upstream_calls() - calls_before,
+        'seconds': time.perf_counter() - started,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Precompute the most reviewed places for a list of cities.")
+    parser.add_argument('cities', help="Text file with one city per line")
+    parser.add_argument('--output', default='sweep', help="Directory of the partitioned dataset")
+    parser.add_argument('--format', choices=list(EXPORT_FORMATS), default='parquet',
+                        help="File format of each city's partition")
+    parser.add_argument('--checkpoint', help="Checkpoint file (default: <output>/_checkpoint.jsonl)")
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--pattern', choices=['single', 'grid', 'hex'], default='grid')
+    parser.add_argument('--radius', type=int, default=2000)
+    parser.add_argument('--cell-radius', type=int, default=1000, help="Query circle radius for --pattern hex")
+    parser.add_argument('--place-type', action='append', dest='place_types',
+                        help="Category to search (repeatable); all main categories by default")
+    parser.add_argument('--fetch-all-pages', action='store_true')
+    parser.add_argument('--call-budget', type=int, help="Upstream calls allowed per city")
+    parser.add_argument('--top-k', type=int, default=0, help="Places kept per city (0 keeps all)")
+    parser.add_argument('--rank-by', choices=list(SCORE_COLUMNS), default='user_ratings_total',
+                        help="Score the places are ranked on")
+    args = parser.parse_args()
+
+    # Workers are spawned fresh (no inherited SQLite connections) and read
+    # these settings at import: the process-wide rate limit is split
+    # between them, and per-span trace lines are off unless asked for
+    from rate_limit import RATE_LIMIT
+    os.environ['PLACES_RATE_LIMIT'] = str(RATE_LIMIT / args.workers)
+    os.environ.setdefault('PLACES_TRACE_LOG_LEVEL', '')
+    from search import MAIN_PLACE_TYPES, SEARCH_CALL_BUDGET
+
+    with open(args.cities) as f:
+        cities = list(dict.fromkeys(line.strip() for line in f if line.strip()))
+    os.makedirs(args.output, exist_ok=True)
+    checkpoint = args.checkpoint or os.path.join(args.output, '_checkpoint.jsonl')
+    done = read_checkpoint(checkpoint)
+    pending = [city for city in cities if city not in done]
+    print(f"{len(cities)} cities, {len(cities) - len(pending)} already done, {len(pending)} to sweep")
+
+    options = {
+        'output': args.output,
+        'format': args.format,
+        'pattern': args.pattern,
+        'radius': args.radius,
+        'cell_radius': args.cell_radius,
+        'place_types': args.place_types or MAIN_PLACE_TYPES,
+        'fetch_all_pages': args.fetch_all_pages,
+        'call_budget': args.call_budget or SEARCH_CALL_BUDGET,
+        'top_k': args.top_k,
+        'rank_by': args.rank_by,
+    }
+    started = time.perf_counter()
+    swept = calls = failed = 0
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=args.workers, mp_context=context) as executor, \
+            open(checkpoint, 'a') as checkpoint_file:
+        futures = {executor.submit(sweep_city, city, options): city for city in pending}
+        for future in as_completed(futures):
+            try:
+                record = future.result()
+            except Exception as error:
+                record = {'city': futures[future], 'status': 'failed', 'error': repr(error), 'calls': 0}
+            checkpoint_file.write(json.dumps(record) + '\n')
+            checkpoint_file.flush()
+            calls += record['calls']
+            if record['status'] != 'ok':
+                failed += 1
+                print(f"FAILED {record['city']}: {record['error']}")
+                continue
+            swept += 1
+            minutes = (time.perf_counter() - started) / 60
+            print(f"{record['city']}: {record['written']} places, {record['calls']} calls, "
+                  f"{record['seconds']:.1f}s ({swept / minutes:.1f} cities/min)")
+
+    minutes = (time.perf_counter() - started) / 60
+    print(f"Swept {swept} cities ({failed} failed) in {minutes * 60:.1f}s: "
+          f"{swept / minutes if minutes else 0:.1f} cities/min, "
+          f"{calls / max(1, swept + failed):.1f} calls/city")
+    print(f"Dataset: {args.output} ({args.format}, partitioned by city)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,177 @@
+import math
+
+from search import METERS_PER_DEGREE, offset_point
+
+# Lattice phases tried along each lattice axis when looking for the
+# placement that needs the fewest circles
+HEX_PHASE_STEPS = 4
+# Lattice rotations tried, in radians (the lattice repeats every 60 degrees)
+HEX_ROTATIONS = (0, math.pi / 6)
+# Sample points per axis used to measure coverage and overlap
+COVERAGE_SAMPLES = 50
+# Most query circles a plan may have; a smaller cell radius for the area is
+# raised to fit, since the lattice search grows with (extent / cell radius)^2
+HEX_MAX_CIRCLES = 500
+# Area of a lattice cell (a hexagon) per squared cell radius
+HEX_CELL_AREA = 3 * math.sqrt(3) / 2
+
+
+def to_local(origin, point):
+    # Project a [lat, lng] point to (east, north) meters around origin
+    lat0, lng0 = origin
+    return (
+        (point[1] - lng0) * METERS_PER_DEGREE * math.cos(math.radians(lat0)),
+        (point[0] - lat0) * METERS_PER_DEGREE,
+    )
+
+
+def _point_in_polygon(x, y, polygon):
+    inside = False
+    for (x1, y1), (x2, y2) in zip(polygon, polygon[1:] + polygon[:1]):
+        if (y1 > y) != (y2 > y) and x < (x2 - x1) * (y - y1) / (y2 - y1) + x1:
+            inside = not inside
+    return inside
+
+
+def _polygon_area(polygon):
+    return abs(sum(x1 * y2 - x2 * y1 for (x1, y1), (x2, y2) in _edges(polygon))) / 2
+
+
+def min_cell_radius(area, max_circles=HEX_MAX_CIRCLES):
+    # Smallest cell radius whose lattice covers `area` square meters with
+    # about max_circles circles
+    return math.sqrt(area / (HEX_CELL_AREA * max_circles))
+
+
+def _segment_distance(px, py, x1, y1, x2, y2):
+    dx, dy = x2 - x1, y2 - y1
+    length = dx * dx + dy * dy
+    t = 0 if length == 0 else max(0, min(1, ((px - x1) * dx + (py - y1) * dy) / length))
+    return math.hypot(px - (x1 + t * dx), py - (y1 + t * dy))
+
+
+def _segments_cross(a, b, c, d):
+    def orientation(p, q, r):
+        return (q[0] - p[0]) * (r[1] - p[1]) - (q[1] - p[1]) * (r[0] - p[0])
+    return (orientation(a, b, c) * orientation(a, b, d) < 0
+            and orientation(c, d, a) * orientation(c, d, b) < 0)
+
+
+def _edges(polygon):
+    return list(zip(polygon, polygon[1:] + polygon[:1]))
+
+
+def _hexagon_touches_target(hexagon, radius, polygon):
+    # Does this lattice cell overlap the target area? The target is either a
+    # disk of the given radius around the origin or a local-meters polygon.
+    if polygon is None:
+        if _point_in_polygon(0, 0, hexagon):
+            return True
+        return min(_segment_distance(0, 0, *a, *b) for a, b in _edges(hexagon)) <= radius
+    if any(_point_in_polygon(x, y, polygon) for x, y in hexagon):
+        return True
+    if any(_point_in_polygon(x, y, hexagon) for x, y in polygon):
+        return True
+    return any(_segments_cross(a, b, c, d)
+               for a, b in _edges(hexagon) for c, d in _edges(polygon))
+
+
+def _lattice_cells(extent, cell_radius, rotation, phase):
+    # Centers of a hexagonal lattice whose Voronoi cells are hexagons of
+    # circumradius cell_radius, so every point of the plane lies within
+    # cell_radius of its nearest center
+    spacing = math.sqrt(3) * cell_radius
+    a1 = (spacing * math.cos(rotation), spacing * math.sin(rotation))
+    a2 = (spacing * math.cos(rotation + math.pi / 3), spacing * math.sin(rotation + math.pi / 3))
+    offset_x = phase[0] * a1[0] + phase[1] * a2[0]
+    offset_y = phase[0] * a1[1] + phase[1] * a2[1]
+    n = int(math.ceil((extent + cell_radius) / (spacing * math.sqrt(3) / 2))) + 1
+    for i in range(-n, n + 1):
+        for j in range(-n, n + 1):
+            x = offset_x + i * a1[0] + j * a2[0]
+            y = offset_y + i * a1[1] + j * a2[1]
+            if math.hypot(x, y) > extent + cell_radius:
+                continue
+            hexagon = [
+                (x + cell_radius * math.cos(rotation + math.pi / 6 + k * math.pi / 3),
+                 y + cell_radius * math.sin(rotation + math.pi / 6 + k * math.pi / 3))
+                for k in range(6)
+            ]
+            yield x, y, hexagon
+
+
+def evaluate_coverage(center, radius, points, cell_radius, polygon=None):
+    # Measure how much of the target area the query circles cover, and how
+    # many circles cover each covered spot on average, on a sample grid
+    origin = list(center)
+    local_polygon = [to_local(origin, p) for p in polygon] if polygon else None
+    if local_polygon:
+        xs = [x for x, _ in local_polygon]
+        ys = [y for _, y in local_polygon]
+        bounds = (min(xs), max(xs), min(ys), max(ys))
+    else:
+        bounds = (-radius, radius, -radius, radius)
+    circles = [to_local(origin, p) for p in points]
+
+    samples = covered = covering = 0
+    for i in range(COVERAGE_SAMPLES):
+        x = bounds[0] + (bounds[1] - bounds[0]) * (i + 0.5) / COVERAGE_SAMPLES
+        for j in range(COVERAGE_SAMPLES):
+            y = bounds[2] + (bounds[3] - bounds[2]) * (j + 0.5) / COVERAGE_SAMPLES
+            if local_polygon:
+                if not _point_in_polygon(x, y, local_polygon):
+                    continue
+            elif math.hypot(x, y) > radius:
+                continue
+            samples += 1
+            hits = sum(1 for cx, cy in circles if math.hypot(x - cx, y - cy) <= cell_radius)
+            if hits:
+                covered += 1
+                covering += hits
+    return {
+        'coverage_ratio': covered / samples if samples else 0.0,
+        'overlap_factor': covering / covered if covered else 0.0,
+    }
+
+
+def plan_hex_coverage(center, radius, cell_radius, polygon=None):
+    # Place query circles of cell_radius on a hexagonal lattice so that the
+    # target (the circle around center, or a [[lat, lng], ...] polygon) is
+    # fully covered. Several lattice phases and rotations are tried and the
+    # one needing the fewest circles wins. A cell radius that would need more
+    # than HEX_MAX_CIRCLES circles (estimated from the area, before any
+    # lattice is enumerated) is raised to fit; the plan's cell_radius and
+    # 'clamped' say so.
+    if polygon:
+        center = [
+            sum(p[0] for p in polygon) / len(polygon),
+            sum(p[1] for p in polygon) / len(polygon),
+        ]
+    origin = list(center)
+    local_polygon = [to_local(origin, p) for p in polygon] if polygon else None
+    extent = max(math.hypot(x, y) for x, y in local_polygon) if local_polygon else radius
+    area = _polygon_area(local_polygon) if local_polygon else math.pi * radius ** 2
+    requested_radius = cell_radius
+    cell_radius = max(cell_radius, min_cell_radius(area))
+
+    best = None
+    for rotation in HEX_ROTATIONS:
+        for u in range(HEX_PHASE_STEPS):
+            for v in range(HEX_PHASE_STEPS):
+                phase = (u / HEX_PHASE_STEPS, v / HEX_PHASE_STEPS)
+                cells = [
+                    (x, y) for x, y, hexagon in _lattice_cells(extent, cell_radius, rotation, phase)
+                    if _hexagon_touches_target(hexagon, radius, local_polygon)
+                ]
+                if best is None or len(cells) < len(best):
+                    best = cells
+
+    points = [offset_point(origin, y, x) for x, y in best]
+    plan = {
+        'center': origin,
+        'cell_radius': cell_radius,
+        'clamped': cell_radius > requested_radius,
+        'points': points,
+    }
+    plan.update(evaluate_coverage(origin, radius, points, cell_radius, polygon))
+    return plan
@@ -0,0 +1,158 @@
+import argparse
+import json
+import os
+import time
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+
+# Bulk export of search results as GeoJSON, CSV or Parquet. Rows are
+# flattened and written a chunk at a time, so time and memory stay flat
+# however many places are exported. Also a CLI for headless runs, e.g. a
+# whole city sweep into one file:
+#   python export.py sweep --format geojson --output places.geojson
+
+# Rows flattened and written per chunk
+EXPORT_CHUNK_ROWS = int(os.getenv('PLACES_EXPORT_CHUNK_ROWS', '5000'))
+EXPORT_FORMATS = {
+    'geojson': ('.geojson', 'application/geo+json'),
+    'csv': ('.csv', 'text/csv'),
+    'parquet': ('.parquet', 'application/vnd.apache.parquet'),
+}
+# Exported place columns, in order; other flat columns of the input (such
+# as a sweep's rank and city) follow them
+EXPORT_SCHEMA = pa.schema([
+    ('place_id', pa.string()),
+    ('name', pa.string()),
+    ('category', pa.string()),
+    ('categories', pa.string()),
+    ('rating', pa.float64()),
+    ('user_ratings_total', pa.int32()),
+    ('bayes_rating', pa.float64()),
+    ('density_reviews', pa.float64()),
+    ('lat', pa.float64()),
+    ('lng', pa.float64()),
+])
+# Separator of the categories a place was found under
+CATEGORY_SEPARATOR = ';'
+
+
+def _flat_column(column, field):
+    # One input column as its export type: dictionaries decoded, category
+    # lists joined, NaN scores written as nulls
+    if pa.types.is_list(column.type):
+        column = pc.binary_join(column.cast(pa.list_(pa.string())), CATEGORY_SEPARATOR)
+    column = column.cast(field.type)
+    if pa.types.is_floating(field.type):
+        column = pc.if_else(pc.is_nan(column), pa.scalar(None, field.type), column)
+    return column
+
+
+def export_schema(schema):
+    # Export schema of a result schema: the place columns it has, then its
+    # other flat columns (list columns such as types are left out)
+    fields = [field for field in EXPORT_SCHEMA if field.name in schema.names]
+    for field in schema:
+        if field.name in EXPORT_SCHEMA.names or pa.types.is_list(field.type):
+            continue
+        fields.append(pa.field(field.name, pa.string()) if pa.types.is_dictionary(field.type) else field)
+    return pa.schema(fields)
+
+
+def flat_batch(batch, schema):
+    return pa.RecordBatch.from_arrays(
+        [_flat_column(batch.column(field.name), field) for field in schema], schema=schema,
+    )
+
+
+class GeoJsonWriter:
+    # FeatureCollection of Points written feature by feature; rows without
+    # coordinates get a null geometry
+
+    def __init__(self, sink, schema):
+        self._sink = sink
+        self._properties = [name for name in schema.names if name not in ('lat', 'lng')]
+        self._first = True
+        self._sink.write(b'{"type":"FeatureCollection","features":[\n')
+
+    def write_batch(self, batch):
+        columns = batch.to_pydict()
+        lats, lngs = columns['lat'], columns['lng']
+        features = []
+        for row in range(batch.num_rows):
+            geometry = (
+                {'type': 'Point', 'coordinates': [lngs[row], lats[row]]}
+                if lats[row] is not None and lngs[row] is not None else None
+            )
+            properties = {name: columns[name][row] for name in self._properties}
+            features.append(json.dumps(
+                {'type': 'Feature', 'geometry': geometry, 'properties': properties},
+                separators=(',', ':'), ensure_ascii=False,
+            ))
+        if features:
+            self._sink.write((('' if self._first else ',\n') + ',\n'.join(features)).encode())
+            self._first = False
+
+    def close(self):
+        self._sink.write(b'\n]}\n')
+
+
+def _writer(export_format, sink, schema):
+    if export_format == 'geojson':
+        return GeoJsonWriter(sink, schema)
+    if export_format == 'csv':
+        return pa_csv.CSVWriter(sink, schema)
+    if export_format == 'parquet':
+        return pq.ParquetWriter(sink, schema)
+    raise ValueError(f"Unknown export format {export_format!r} (expected one of {', '.join(EXPORT_FORMATS)})")
+
+
+def export_batches(batches, schema, export_format, sink):
+    # Flatten and write record batches of `schema` to `sink` (a binary file
+    # object, or a path). Returns the rows written.
+    if isinstance(sink, (str, os.PathLike)):
+        with open(sink, 'wb') as f:
+            return export_batches(batches, schema, export_format, f)
+    flat_schema = export_schema(schema)
+    writer = _writer(export_format, sink, flat_schema)
+    rows = 0
+    try:
+        for batch in batches:
+            writer.write_batch(flat_batch(batch, flat_schema))
+            rows += batch.num_rows
+    finally:
+        writer.close()
+    return rows
+
+
+def export_table(table, export_format, sink, chunk_rows=EXPORT_CHUNK_ROWS):
+    # Export an Arrow table (e.g. PlaceTable.table) chunk by chunk
+    return export_batches(table.to_batches(max_chunksize=chunk_rows), table.schema, export_format, sink)
+
+
+def export_dataset(source, export_format, sink, chunk_rows=EXPORT_CHUNK_ROWS):
+    # Export a Parquet file or a (hive-partitioned) dataset directory, such
+    # as city_sweep.py's output, without loading it whole (pyarrow.dataset
+    # is only imported here, off the app's startup path)
+    import pyarrow.dataset as ds
+
+    dataset = ds.dataset(source, format='parquet', partitioning='hive')
+    return export_batches(dataset.to_batches(batch_size=chunk_rows), dataset.schema, export_format, sink)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export saved search results as GeoJSON, CSV or Parquet.")
+    parser.add_argument('source', help="Parquet file or dataset directory (e.g. a city_sweep.py output)")
+    parser.add_argument('--format', choices=list(EXPORT_FORMATS), default='geojson')
+    parser.add_argument('--output', help="Output file (default: <source name> plus the format's extension)")
+    args = parser.parse_args()
+    output = args.output or os.path.normpath(args.source).rsplit('.parquet', 1)[0] + EXPORT_FORMATS[args.format][0]
+    started = time.perf_counter()
+    rows = export_dataset(args.source, args.format, output)
+    print(f"Exported {rows} places to {output} in {time.perf_counter() - started:.1f}s")
+
+
+if __name__ == '__main__':
+    main()
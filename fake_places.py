@@ -0,0 +1,283 @@
+import json
+import math
+import os
+import random
+import threading
+import time
+import zlib
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import requests
+from requests.adapters import BaseAdapter
+
+# Offline stand-in for the Places findplacefromtext and nearbysearch
+# endpoints and the Places API (New) places:searchNearby, mounted on the
+# shared HTTP session (PLACES_FAKE_API=1 or install()). Each city is a
+# synthetic dataset generated from its name, or a recorded one loaded from
+# PLACES_FAKE_DATASET. Synthetic places carry the bulky fields real
+# nearbysearch results have, so backend payload sizes compare fairly.
+
+# Median and spread of the simulated request latency, in seconds
+FAKE_LATENCY = float(os.getenv('PLACES_FAKE_LATENCY', '0.15'))
+FAKE_LATENCY_SIGMA = 0.35
+# Seconds before a next_page_token is accepted (INVALID_REQUEST until then)
+FAKE_TOKEN_DELAY = float(os.getenv('PLACES_FAKE_TOKEN_DELAY', '2.0'))
+# Places generated per synthetic city
+FAKE_CITY_PLACES = int(os.getenv('PLACES_FAKE_CITY_PLACES', '6000'))
+# Spread of the synthetic places around the city center, in meters
+FAKE_CITY_SPREAD = 3000
+# The nearbysearch caps: 20 results per page, 3 pages
+FAKE_PAGE_SIZE = 20
+FAKE_MAX_PAGES = 3
+# Cities whose center is this far from a search are not loaded for it
+FAKE_CITY_REACH = 50000
+# Kept here rather than imported from search, which imports http_client
+METERS_PER_DEGREE = 111320
+
+FAKE_CITIES = {
+    'paris': (48.8566, 2.3522),
+    'london': (51.5074, -0.1278),
+    'new york': (40.7128, -74.0060),
+    'tokyo': (35.6762, 139.6503),
+    'berlin': (52.5200, 13.4050),
+    'rome': (41.9028, 12.4964),
+}
+
+# Relative frequency of each place type in a synthetic city
+FAKE_PLACE_TYPES = {
+    'restaurant': 30, 'cafe': 12, 'bar': 10, 'store': 10, 'clothing_store': 5,
+    'bakery': 4, 'lodging': 4, 'supermarket': 3, 'pharmacy': 3, 'tourist_attraction': 3,
+    'museum': 2, 'park': 2, 'church': 2, 'art_gallery': 2, 'night_club': 2,
+    'atm': 2, 'parking': 2, 'library': 1,
+}
+
+
+def distance_meters(lat1, lng1, lat2, lng2):
+    north = (lat2 - lat1) * METERS_PER_DEGREE
+    east = (lng2 - lng1) * METERS_PER_DEGREE * math.cos(math.radians(lat1))
+    return math.hypot(north, east)
+
+
+def synthetic_city(name, center, count=FAKE_CITY_PLACES):
+    # Places clustered around the center, with long-tailed review counts
+    rng = np.random.default_rng(zlib.crc32(name.encode()))
+    lat, lng = center
+    north = rng.normal(0, FAKE_CITY_SPREAD, count)
+    east = rng.normal(0, FAKE_CITY_SPREAD, count)
+    types = list(FAKE_PLACE_TYPES)
+    weights = np.array(list(FAKE_PLACE_TYPES.values()), dtype=float)
+    type_indices = rng.choice(len(types), count, p=weights / weights.sum())
+    reviews = rng.lognormal(4, 1.6, count).astype(int)
+    ratings = np.clip(rng.normal(4.2, 0.4, count), 1, 5).round(1)
+    places = []
+    for i in range(count):
+        place_type = types[type_indices[i]]
+        place_id = f"fake-{zlib.crc32(name.encode()):08x}-{i}"
+        place_lat = lat + north[i] / METERS_PER_DEGREE
+        place_lng = lng + east[i] / (METERS_PER_DEGREE * math.cos(math.radians(lat)))
+        places.append({
+            'place_id': place_id,
+            'name': f"{place_type.replace('_', ' ').title()} {i}",
+            'geometry': {
+                'location': {'lat': place_lat, 'lng': place_lng},
+                'viewport': {
+                    'northeast': {'lat': place_lat + 0.0013, 'lng': place_lng + 0.0013},
+                    'southwest': {'lat': place_lat - 0.0013, 'lng': place_lng - 0.0013},
+                },
+            },
+            'rating': float(ratings[i]),
+            'user_ratings_total': int(reviews[i]),
+            'types': [place_type, 'point_of_interest', 'establishment'],
+            'vicinity': f"{i} Fake Street",
+            'business_status': 'OPERATIONAL',
+            'icon': "https://maps.gstatic.com/mapfiles/place_api/icons/v1/png_71/generic_business-71.png",
+            'icon_background_color': '#7B9EB0',
+            'icon_mask_base_uri': "https://maps.gstatic.com/mapfiles/place_api/icons/v2/generic_pinlet",
+            'opening_hours': {'open_now': bool(i % 3)},
+            'photos': [{
+                'height': 3024,
+                'width': 4032,
+                'html_attributions': [f'<a href="https://maps.google.com/maps/contrib/{i}">A Contributor</a>'],
+                'photo_reference': f"{place_id}-photo-" + 'x' * 160,
+            }],
+            'plus_code': {'compound_code': f"{i:04d}+FAKE {name.title()}", 'global_code': f"8FW4{i:04d}+FAKE"},
+            'reference': place_id,
+            'scope': 'GOOGLE',
+        })
+    return places
+
+
+def search_nearby_place(place):
+    # A place as Places API (New) represents it, every field present
+    location = place['geometry']['location']
+    resource = {
+        'name': f"places/{place['place_id']}",
+        'id': place['place_id'],
+        'displayName': {'text': place.get('name'), 'languageCode': 'en'},
+        'types': place.get('types', []),
+        'formattedAddress': place.get('vicinity'),
+        'location': {'latitude': location['lat'], 'longitude': location['lng']},
+        'userRatingCount': place.get('user_ratings_total', 0),
+        'businessStatus': place.get('business_status'),
+        'photos': [{'name': f"places/{place['place_id']}/photos/{photo.get('photo_reference')}"}
+                   for photo in place.get('photos', [])],
+    }
+    if 'rating' in place:
+        resource['rating'] = place['rating']
+    return resource
+
+
+def load_dataset(path):
+    # A recorded dataset: {"city name": {"center": [lat, lng], "places": [...]}}
+    with open(path) as f:
+        return {name.lower(): (tuple(city['center']), city['places']) for name, city in json.load(f).items()}
+
+
+class FakePlacesAdapter(BaseAdapter):
+    # requests transport adapter answering Places API URLs from local
+    # datasets, with simulated latency and page token delays
+
+    def __init__(self, dataset_path=None, latency=FAKE_LATENCY, token_delay=FAKE_TOKEN_DELAY, seed=None):
+        super().__init__()
+        self.latency = latency
+        self.token_delay = token_delay
+        self.calls = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._tokens = {}  # token -> (issued at, places, page)
+        self._cities = load_dataset(dataset_path) if dataset_path else {}
+        self._arrays = {}  # city -> (lat array, lng array, places)
+
+    def _center(self, name):
+        return self._cities[name][0] if name in self._cities else FAKE_CITIES[name]
+
+    def _city(self, name):
+        with self._lock:
+            if name not in self._cities:
+                if name not in FAKE_CITIES:
+                    return None
+                self._cities[name] = (FAKE_CITIES[name], synthetic_city(name, FAKE_CITIES[name]))
+            if name not in self._arrays:
+                places = self._cities[name][1]
+                self._arrays[name] = (
+                    np.array([p['geometry']['location']['lat'] for p in places]),
+                    np.array([p['geometry']['location']['lng'] for p in places]),
+                    places,
+                )
+            return self._cities[name][0]
+
+    def _city_names(self):
+        return list(self._cities) + [name for name in FAKE_CITIES if name not in self._cities]
+
+    def _find_place(self, params):
+        query = params.get('input', '').lower()
+        for name in self._city_names():
+            if name in query:
+                lat, lng = self._city(name)
+                return {'status': 'OK', 'candidates': [
+                    {'name': name.title(), 'geometry': {'location': {'lat': lat, 'lng': lng}}}
+                ]}
+        return {'status': 'ZERO_RESULTS', 'candidates': []}
+
+    def _places_within(self, lat, lng, radius, place_type):
+        # Places of place_type (any type when None) within radius, most
+        # prominent (reviewed) first
+        places = []
+        for name in self._city_names():
+            center_lat, center_lng = self._center(name)
+            if distance_meters(lat, lng, center_lat, center_lng) > FAKE_CITY_REACH + radius:
+                continue
+            self._city(name)
+            lats, lngs, city_places = self._arrays[name]
+            north = (lats - lat) * METERS_PER_DEGREE
+            east = (lngs - lng) * METERS_PER_DEGREE * math.cos(math.radians(lat))
+            for i in np.nonzero(np.hypot(north, east) <= radius)[0]:
+                if place_type is None or place_type in city_places[i]['types']:
+                    places.append(city_places[i])
+        places.sort(key=lambda place: place['user_ratings_total'], reverse=True)
+        return places
+
+    def _search_nearby(self, body, field_mask):
+        # (HTTP status, payload) of a places:searchNearby request; only the
+        # masked fields come back, and an empty answer is {}
+        if not field_mask:
+            return 400, {'error': {'code': 400, 'status': 'INVALID_ARGUMENT',
+                                   'message': "FieldMask is a required parameter."}}
+        circle = body['locationRestriction']['circle']
+        included = body.get('includedTypes') or [None]
+        places = self._places_within(
+            circle['center']['latitude'], circle['center']['longitude'], circle['radius'], included[0],
+        )[:body.get('maxResultCount', FAKE_PAGE_SIZE)]
+        if not places:
+            return 200, {}
+        fields = None if field_mask == '*' else {
+            field.split('.', 1)[1] for field in field_mask.split(',') if field.startswith('places.')
+        }
+        return 200, {'places': [
+            {key: value for key, value in search_nearby_place(place).items() if fields is None or key in fields}
+            for place in places
+        ]}
+
+    def _nearby(self, params):
+        token = params.get('pagetoken')
+        if token:
+            with self._lock:
+                issued = self._tokens.get(token)
+            if issued is None or time.monotonic() < issued[0]:
+                return {'status': 'INVALID_REQUEST', 'results': []}
+            _, places, page = issued
+        else:
+            lat, lng = (float(value) for value in params['location'].split(','))
+            radius = float(params.get('radius', 0))
+            # Ranked by prominence, which reviews stand in for
+            places = self._places_within(lat, lng, radius, params.get('type'))[:FAKE_PAGE_SIZE * FAKE_MAX_PAGES]
+            page = 0
+        results = places[page * FAKE_PAGE_SIZE:(page + 1) * FAKE_PAGE_SIZE]
+        payload = {'status': 'OK' if results else 'ZERO_RESULTS', 'results': results, 'html_attributions': []}
+        if (page + 1) * FAKE_PAGE_SIZE < len(places):
+            next_token = f"token-{self._random.getrandbits(64):016x}"
+            with self._lock:
+                self._tokens[next_token] = (time.monotonic() + self.token_delay, places, page + 1)
+            payload['next_page_token'] = next_token
+        return payload
+
+    def send(self, request, **kwargs):
+        url = urlparse(request.url)
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        if self.latency:
+            time.sleep(self._random.lognormvariate(math.log(self.latency), FAKE_LATENCY_SIGMA))
+        with self._lock:
+            self.calls += 1
+        status_code = 200
+        if url.path.endswith('/findplacefromtext/json'):
+            payload = self._find_place(params)
+        elif url.path.endswith('/nearbysearch/json'):
+            payload = self._nearby(params)
+        elif url.path.endswith('/places:searchNearby') and request.method == 'POST':
+            status_code, payload = self._search_nearby(
+                json.loads(request.body), request.headers.get('X-Goog-FieldMask'),
+            )
+        else:
+            status_code, payload = 404, None
+
+        response = requests.Response()
+        response.status_code = status_code
+        response._content = json.dumps(payload).encode() if payload is not None else b''
+        response.headers['Content-Type'] = 'application/json'
+        response.headers['Content-Length'] = str(len(response._content))
+        response.url = request.url
+        response.request = request
+        response.encoding = 'utf-8'
+        return response
+
+    def close(self):
+        pass
+
+
+def install(session, **kwargs):
+    # Route a session's Google Maps requests to a new fake; returns it
+    adapter = FakePlacesAdapter(**kwargs)
+    session.mount('https://maps.googleapis.com/', adapter)
+    session.mount('https://places.googleapis.com/', adapter)
+    return adapter
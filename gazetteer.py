@@ -0,0 +1,393 @@
+import argparse
+import bisect
+import io
+import json
+import mmap
+import os
+import re
+import threading
+import unicodedata
+import zipfile
+
+import numpy as np
+
+# Local gazetteer: city names resolved and suggested from memory-mapped
+# files instead of the findplacefromtext API. Built offline from a GeoNames
+# cities dump (https://download.geonames.org/export/dump/cities15000.zip),
+# optionally with the country and admin1 names of countryInfo.txt and
+# admin1CodesASCII.txt so qualified queries ("Paris, Texas") resolve too:
+#   python gazetteer.py build cities15000.zip --countries countryInfo.txt \
+#       --admin1 admin1CodesASCII.txt --output gazetteer
+# Names (official, ASCII and alternate) are normalized into sorted keys for
+# exact and prefix lookups, plus a trigram index for misspelt input. Places
+# the API had to resolve are appended to learned.jsonl next to the index
+# and answered locally afterwards.
+
+# Directory of the built index ('' disables the gazetteer)
+GAZETTEER_PATH = os.getenv('PLACES_GAZETTEER_PATH', 'gazetteer')
+# Suggestions returned for a partial query
+SUGGESTION_COUNT = 8
+# Trigram similarity a misspelt key needs to be suggested
+MIN_TRIGRAM_SIMILARITY = 0.45
+# Sorts after every character a normalized key can hold
+KEY_UPPER_BOUND = '~'
+# Alternate names longer than this are left out of the index
+MAX_KEY_LENGTH = 40
+
+PLACE_DTYPE = np.dtype([
+    ('lat', 'f8'), ('lng', 'f8'), ('population', 'i8'),
+    ('name_start', 'i8'), ('name_end', 'i8'), ('country', 'S2'), ('admin1', 'S20'),
+])
+LEARNED_FILE = 'learned.jsonl'
+# Normalized names of countries ('FR') and admin1 regions ('US.TX')
+REGIONS_FILE = 'regions.json'
+
+
+def normalize(text):
+    # ASCII, lower case, words separated by single spaces
+    text = unicodedata.normalize('NFKD', str(text)).encode('ascii', 'ignore').decode().lower()
+    return ' '.join(re.sub(r'[^a-z0-9]+', ' ', text).split())
+
+
+def trigram_codes(key):
+    # Distinct trigrams of a padded key, packed into integers
+    padded = f"  {key} ".encode()
+    return sorted({padded[i] << 16 | padded[i + 1] << 8 | padded[i + 2] for i in range(len(padded) - 2)})
+
+
+def place_answer(name, lat, lng):
+    # Same shape as a findplacefromtext candidate
+    return {'name': name, 'geometry': {'location': {'lat': lat, 'lng': lng}}}
+
+
+class _SortedKeys:
+    # Sequence view of the sorted key blob, for bisect
+
+    def __init__(self, blob, offsets):
+        self._blob = blob
+        self._offsets = offsets
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, i):
+        return self._blob[int(self._offsets[i]):int(self._offsets[i + 1])].decode()
+
+
+class Gazetteer:
+    # Read-only memory-mapped index plus the learned answers. Lookups are
+    # a binary search over the key blob (exact, prefix) or a few posting
+    # list slices (trigrams); nothing is loaded into memory up front.
+
+    def __init__(self, path=GAZETTEER_PATH):
+        self.path = path
+        self._files = []
+        self.places = np.load(os.path.join(path, 'places.npy'), mmap_mode='r')
+        self.names = self._map('names.bin')
+        self.key_offsets = np.load(os.path.join(path, 'key_offsets.npy'), mmap_mode='r')
+        self.key_places = np.load(os.path.join(path, 'key_places.npy'), mmap_mode='r')
+        self.trigrams = np.load(os.path.join(path, 'trigrams.npy'), mmap_mode='r')
+        self.trigram_offsets = np.load(os.path.join(path, 'trigram_offsets.npy'), mmap_mode='r')
+        self.trigram_keys = np.load(os.path.join(path, 'trigram_keys.npy'), mmap_mode='r')
+        self.keys = _SortedKeys(self._map('keys.bin'), self.key_offsets)
+        self.regions = {}
+        regions_path = os.path.join(path, REGIONS_FILE)
+        if os.path.exists(regions_path):
+            with open(regions_path) as f:
+                self.regions = json.load(f)
+        self._lock = threading.Lock()
+        self._learned = {}  # normalized query -> answer
+        self.hits = 0
+        self.misses = 0
+        learned_path = os.path.join(path, LEARNED_FILE)
+        if os.path.exists(learned_path):
+            with open(learned_path) as f:
+                for line in f:
+                    if line.strip():
+                        record = json.loads(line)
+                        self._learned[record['key']] = place_answer(record['name'], record['lat'], record['lng'])
+
+    def _map(self, name):
+        f = open(os.path.join(self.path, name), 'rb')
+        self._files.append(f)
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _place(self, index):
+        place = self.places[index]
+        name = self.names[int(place['name_start']):int(place['name_end'])].decode()
+        return {
+            'name': name,
+            'country': place['country'].decode(),
+            'population': int(place['population']),
+            'lat': float(place['lat']),
+            'lng': float(place['lng']),
+        }
+
+    def _key_range(self, prefix, exact=False):
+        # [start, stop) of the keys equal to, or starting with, prefix
+        start = bisect.bisect_left(self.keys, prefix)
+        if exact:
+            return start, bisect.bisect_right(self.keys, prefix, start)
+        return start, bisect.bisect_left(self.keys, prefix + KEY_UPPER_BOUND, start)
+
+    def _best_places(self, start, stop, count):
+        # Distinct places of the keys in [start, stop), most populous first,
+        # ranked over the whole range (a short prefix spans many thousands
+        # of keys; only the top ones are sorted)
+        places = np.asarray(self.key_places[start:stop])
+        population = self.places['population'][places]
+        selected = min(len(places), count)
+        while True:
+            if selected < len(places):
+                top = np.argpartition(-population, selected - 1)[:selected]
+            else:
+                top = np.arange(len(places))
+            top = top[np.lexsort((places[top], -population[top]))]
+            best = list(dict.fromkeys(int(index) for index in places[top]))[:count]
+            # Several keys of one place can take the top slots: widen until
+            # there are enough distinct places
+            if len(best) >= count or selected >= len(places):
+                return best
+            selected = min(len(places), selected * 4)
+
+    def resolve(self, query):
+        # Answer for a complete city query ("Paris", "paris, france"), or
+        # None. Only whole names count; ambiguous names go to the most
+        # populous place. Qualifiers after commas must each name the place's
+        # country or admin1 region (by code, or by name when the index was
+        # built with them), otherwise the query is left to the API.
+        key = normalize(query)
+        answer = self._lookup(key)
+        if answer is None and ',' in str(query):
+            name, *qualifiers = str(query).split(',')
+            answer = self._lookup(normalize(name), [normalize(part) for part in qualifiers if normalize(part)])
+        with self._lock:
+            if answer is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return answer
+
+    def _lookup(self, key, qualifiers=None):
+        if not key:
+            return None
+        if not qualifiers:
+            with self._lock:
+                learned = self._learned.get(key)
+            if learned is not None:
+                return learned
+        start, stop = self._key_range(key, exact=True)
+        if start == stop:
+            return None
+        for index in self._best_places(start, stop, stop - start):
+            if qualifiers and not set(qualifiers) <= self._region_names(index):
+                continue
+            place = self._place(index)
+            return place_answer(place['name'], place['lat'], place['lng'])
+        return None
+
+    def _region_names(self, index):
+        # Normalized codes and names of a place's country and admin1 region
+        place = self.places[index]
+        country = place['country'].decode()
+        admin1 = place['admin1'].decode()
+        names = {normalize(country), *self.regions.get(country, [])}
+        if admin1:
+            names.add(normalize(admin1))
+            names.update(self.regions.get(f"{country}.{admin1}", []))
+        return names
+
+    def suggest(self, text, count=SUGGESTION_COUNT):
+        # Places for a partial query: prefix matches first, then names that
+        # are close by trigram similarity (typos), most populous first
+        key = normalize(text)
+        if not key:
+            return []
+        start, stop = self._key_range(key)
+        indices = self._best_places(start, stop, count) if stop > start else []
+        if len(indices) < count and len(key) >= 3:
+            for index in self._similar_places(key, count):
+                if index not in indices:
+                    indices.append(index)
+        suggestions = [self._place(index) for index in indices[:count]]
+        with self._lock:
+            learned = [(learned_key, answer) for learned_key, answer in self._learned.items()
+                       if learned_key.startswith(key)]
+        for learned_key, answer in learned[:max(0, count - len(suggestions))]:
+            location = answer['geometry']['location']
+            suggestions.append({'name': answer['name'], 'country': '', 'population': 0,
+                                'lat': location['lat'], 'lng': location['lng']})
+        return suggestions
+
+    def _similar_places(self, key, count):
+        codes = np.array(trigram_codes(key), dtype=np.uint32)
+        positions = np.searchsorted(self.trigrams, codes)
+        found = positions < len(self.trigrams)
+        found[found] = np.asarray(self.trigrams[positions[found]]) == codes[found]
+        postings = [
+            np.asarray(self.trigram_keys[self.trigram_offsets[position]:self.trigram_offsets[position + 1]])
+            for position in positions[found]
+        ]
+        if not postings:
+            return []
+        key_ids, shared = np.unique(np.concatenate(postings), return_counts=True)
+        # Dice similarity; a key of n characters has n + 2 padded trigrams
+        key_lengths = np.asarray(self.key_offsets[key_ids + 1] - self.key_offsets[key_ids])
+        similarity = 2 * shared / (len(codes) + key_lengths + 2)
+        close = similarity >= MIN_TRIGRAM_SIMILARITY
+        key_ids, similarity = key_ids[close], similarity[close]
+        places = np.asarray(self.key_places[key_ids])
+        population = self.places['population'][places]
+        order = np.lexsort((-population, -np.round(similarity, 2)))
+        return list(dict.fromkeys(int(index) for index in places[order]))[:count]
+
+    def learn(self, query, answer):
+        # Keep an API answer so the same query is resolved locally next time
+        key = normalize(query)
+        location = answer.get('geometry', {}).get('location')
+        if not key or not location:
+            return
+        record = {'key': key, 'name': answer.get('name') or query, 'lat': location['lat'], 'lng': location['lng']}
+        with self._lock:
+            if key in self._learned:
+                return
+            self._learned[key] = place_answer(record['name'], record['lat'], record['lng'])
+            with open(os.path.join(self.path, LEARNED_FILE), 'a') as f:
+                f.write(json.dumps(record) + '\n')
+
+    def stats(self):
+        with self._lock:
+            return {
+                'places': len(self.places),
+                'keys': len(self.keys),
+                'learned': len(self._learned),
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+
+def _read_lines(path):
+    # Lines of a GeoNames file, zipped or not
+    if path.endswith('.zip'):
+        with zipfile.ZipFile(path) as archive:
+            member = next(name for name in archive.namelist() if name.endswith('.txt'))
+            return io.TextIOWrapper(archive.open(member), encoding='utf-8').readlines()
+    with open(path, encoding='utf-8') as f:
+        return f.readlines()
+
+
+def read_geonames(path):
+    # (name, ascii name, alternate names, lat, lng, country, admin1 code,
+    # population) rows of a GeoNames cities dump
+    for line in _read_lines(path):
+        fields = line.rstrip('\n').split('\t')
+        if len(fields) < 15:
+            continue
+        yield (fields[1], fields[2], fields[3].split(',') if fields[3] else [],
+               float(fields[4]), float(fields[5]), fields[8], fields[10], int(fields[14] or 0))
+
+
+def read_regions(countries=None, admin1=None):
+    # {'FR': names, 'US.TX': names} from GeoNames countryInfo.txt (ISO,
+    # ISO3 and country name) and admin1CodesASCII.txt (name, ASCII name)
+    regions = {}
+    for path, columns in ((countries, (0, 1, 4)), (admin1, (1, 2))):
+        if not path:
+            continue
+        for line in _read_lines(path):
+            if line.startswith('#'):
+                continue
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) <= max(columns):
+                continue
+            names = regions.setdefault(fields[0], [])
+            for column in columns:
+                name = normalize(fields[column])
+                if name and name not in names:
+                    names.append(name)
+    return regions
+
+
+def build(source, output, countries=None, admin1=None):
+    # Write the index files for a GeoNames dump into `output`
+    os.makedirs(output, exist_ok=True)
+    places = []
+    names = bytearray()
+    keys = {}  # key -> place indices
+    for name, ascii_name, alternates, lat, lng, country, admin1_code, population in read_geonames(source):
+        index = len(places)
+        encoded = name.encode()
+        places.append((lat, lng, population, len(names), len(names) + len(encoded),
+                       country.encode()[:2], admin1_code.encode()[:20]))
+        names += encoded
+        for alias in {name, ascii_name, *alternates}:
+            key = normalize(alias)
+            if key and len(key) <= MAX_KEY_LENGTH:
+                keys.setdefault(key, set()).add(index)
+
+    sorted_keys = sorted(keys)
+    key_blob = bytearray()
+    key_offsets = [0]
+    key_places = []
+    for key in sorted_keys:
+        for index in sorted(keys[key]):
+            # A key shared by several places is stored once per place
+            key_blob += key.encode()
+            key_offsets.append(len(key_blob))
+            key_places.append(index)
+
+    codes, code_keys = [], []
+    for key_id in range(len(key_places)):
+        key = key_blob[key_offsets[key_id]:key_offsets[key_id + 1]].decode()
+        for code in trigram_codes(key):
+            codes.append(code)
+            code_keys.append(key_id)
+    codes = np.array(codes, dtype=np.uint32)
+    code_keys = np.array(code_keys, dtype=np.int32)
+    order = np.argsort(codes, kind='stable')
+    trigrams, starts = np.unique(codes[order], return_index=True)
+
+    np.save(os.path.join(output, 'places.npy'), np.array(places, dtype=PLACE_DTYPE))
+    with open(os.path.join(output, 'names.bin'), 'wb') as f:
+        f.write(names)
+    with open(os.path.join(output, 'keys.bin'), 'wb') as f:
+        f.write(key_blob)
+    np.save(os.path.join(output, 'key_offsets.npy'), np.array(key_offsets, dtype=np.int64))
+    np.save(os.path.join(output, 'key_places.npy'), np.array(key_places, dtype=np.int32))
+    np.save(os.path.join(output, 'trigrams.npy'), trigrams)
+    np.save(os.path.join(output, 'trigram_offsets.npy'), np.append(starts, len(codes)).astype(np.int64))
+    np.save(os.path.join(output, 'trigram_keys.npy'), code_keys[order])
+    with open(os.path.join(output, REGIONS_FILE), 'w') as f:
+        json.dump(read_regions(countries, admin1), f)
+    return len(places), len(key_places)
+
+
+def load_gazetteer(path=GAZETTEER_PATH):
+    # The gazetteer at `path`, or None when it has not been built
+    if not path or not os.path.exists(os.path.join(path, 'places.npy')):
+        return None
+    if np.load(os.path.join(path, 'places.npy'), mmap_mode='r').dtype != PLACE_DTYPE:
+        # Built by an older version: rebuild it to use it again
+        return None
+    return Gazetteer(path)
+
+
+# Process-wide gazetteer (None until `python gazetteer.py build` has run)
+local_gazetteer = load_gazetteer()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the local city gazetteer from a GeoNames dump.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    build_parser = subparsers.add_parser('build')
+    build_parser.add_argument('source', help="GeoNames cities file (e.g. cities15000.zip or .txt)")
+    build_parser.add_argument('--countries', help="GeoNames countryInfo.txt, to match country names")
+    build_parser.add_argument('--admin1', help="GeoNames admin1CodesASCII.txt, to match region names")
+    build_parser.add_argument('--output', default=GAZETTEER_PATH or 'gazetteer')
+    args = parser.parse_args()
+    place_count, key_count = build(args.source, args.output, args.countries, args.admin1)
+    print(f"Indexed {place_count} places under {key_count} names in {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,161 @@
+import os
+import random
+import threading
+import time
+from collections import deque
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import tracing
+from rate_limit import places_limiter
+
+# Connections kept open to maps.googleapis.com, shared by every session
+HTTP_POOL_SIZE = int(os.getenv('PLACES_HTTP_POOL_SIZE', '32'))
+# (connect, read) timeouts in seconds for every request
+HTTP_TIMEOUT = (
+    float(os.getenv('PLACES_HTTP_CONNECT_TIMEOUT', '3.05')),
+    float(os.getenv('PLACES_HTTP_READ_TIMEOUT', '10')),
+)
+# Retries after a connection error, a 5xx answer or OVER_QUERY_LIMIT
+HTTP_MAX_RETRIES = int(os.getenv('PLACES_HTTP_MAX_RETRIES', '3'))
+HTTP_RETRY_BACKOFF = 0.5
+# Latency samples kept per endpoint for the percentile stats
+LATENCY_SAMPLES = 1000
+
+_session = requests.Session()
+_session.headers.update({'Accept-Encoding': 'gzip, deflate'})
+_adapter = HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_SIZE)
+_session.mount('https://', _adapter)
+_session.mount('http://', _adapter)
+
+# PLACES_FAKE_API=1 answers Google Maps requests from the offline fake in
+# fake_places.py (optionally with a recorded PLACES_FAKE_DATASET)
+if os.getenv('PLACES_FAKE_API'):
+    import fake_places
+    fake_places.install(_session, dataset_path=os.getenv('PLACES_FAKE_DATASET') or None)
+
+_stats_lock = threading.Lock()
+_stats = {}
+
+
+def _record(endpoint, elapsed, retries, failed, received=0, parse_seconds=0.0):
+    with _stats_lock:
+        stats = _stats.setdefault(endpoint, {
+            'calls': 0,
+            'errors': 0,
+            'retries': 0,
+            'bytes': 0,
+            'parse_seconds': 0.0,
+            'total_seconds': 0.0,
+            'max_seconds': 0.0,
+            'samples': deque(maxlen=LATENCY_SAMPLES),
+        })
+        stats['calls'] += 1
+        stats['errors'] += failed
+        stats['retries'] += retries
+        stats['bytes'] += received
+        stats['parse_seconds'] += parse_seconds
+        stats['total_seconds'] += elapsed
+        stats['max_seconds'] = max(stats['max_seconds'], elapsed)
+        stats['samples'].append(elapsed)
+
+
+def endpoint_name(url):
+    # 'nearbysearch' for .../place/nearbysearch/json
+    parts = urlparse(url).path.rstrip('/').split('/')
+    return parts[-2] if parts[-1] in ('json', 'xml') else parts[-1]
+
+
+def response_size(response):
+    # Bytes on the wire (compressed) when the server says, else body bytes
+    return int(response.headers.get('Content-Length') or len(response.content))
+
+
+def retry_delay(attempt):
+    # Exponential backoff with full jitter, so retries from concurrent
+    # sessions do not all land on the API at the same moment
+    return random.uniform(0, HTTP_RETRY_BACKOFF * 2 ** attempt)
+
+
+def get_json(url, params=None, parse=None):
+    # GET a Google Maps JSON endpoint through the shared pooled session.
+    # Every attempt first takes a token from the process-wide rate limiter.
+    # Returns (HTTP status code, parsed payload or None); `parse` turns the
+    # decoded payload into what is returned, and counts as parse time.
+    # Connection errors raise requests.RequestException once the retries
+    # are used up.
+    return _request_json('GET', url, parse, params=params)
+
+
+def post_json(url, body, headers=None, parse=None):
+    # POST a JSON body (Places API (New) endpoints), otherwise like get_json
+    return _request_json('POST', url, parse, json=body, headers=headers)
+
+
+def _request_json(method, url, parse, **request_args):
+    endpoint = endpoint_name(url)
+    started = time.monotonic()
+    attempt = 0
+    throttled = 0.0
+    while True:
+        if places_limiter is not None:
+            # Time spent waiting for the limiter is not upstream latency
+            waited = places_limiter.acquire()
+            throttled += waited
+            started += waited
+        try:
+            response = _session.request(method, url, timeout=HTTP_TIMEOUT, **request_args)
+        except requests.RequestException:
+            if attempt >= HTTP_MAX_RETRIES:
+                _record(endpoint, time.monotonic() - started, attempt, True)
+                tracing.annotate(endpoint=endpoint, retries=attempt)
+                raise
+        else:
+            parse_started = time.perf_counter()
+            payload = response.json() if response.status_code == 200 else None
+            parse_seconds = time.perf_counter() - parse_started
+            retryable = (
+                response.status_code >= 500
+                or response.status_code == 429
+                or (payload is not None and payload.get('status') == 'OVER_QUERY_LIMIT')
+            )
+            if not retryable or attempt >= HTTP_MAX_RETRIES:
+                elapsed = time.monotonic() - started
+                if payload is not None and parse is not None:
+                    parse_started = time.perf_counter()
+                    payload = parse(payload)
+                    parse_seconds += time.perf_counter() - parse_started
+                size = response_size(response)
+                _record(endpoint, elapsed, attempt, response.status_code != 200, size, parse_seconds)
+                tracing.annotate(
+                    endpoint=endpoint, http_status=response.status_code, bytes=size, retries=attempt,
+                    http_seconds=round(elapsed, 4), throttled_seconds=round(throttled, 4),
+                    parse_seconds=round(parse_seconds, 5),
+                )
+                return response.status_code, payload
+        time.sleep(retry_delay(attempt))
+        attempt += 1
+
+
+def latency_stats():
+    # Per-endpoint call counts, response bytes, latencies (seconds, retries
+    # included) and time spent decoding and normalizing responses
+    summary = {}
+    with _stats_lock:
+        for endpoint, stats in _stats.items():
+            samples = sorted(stats['samples'])
+            summary[endpoint] = {
+                'calls': stats['calls'],
+                'errors': stats['errors'],
+                'retries': stats['retries'],
+                'bytes': stats['bytes'],
+                'parse_seconds': stats['parse_seconds'],
+                'mean_parse_seconds': stats['parse_seconds'] / stats['calls'],
+                'mean_seconds': stats['total_seconds'] / stats['calls'],
+                'p50_seconds': samples[len(samples) // 2],
+                'p95_seconds': samples[min(len(samples) - 1, int(len(samples) * 0.95))],
+                'max_seconds': stats['max_seconds'],
+            }
+    return summary
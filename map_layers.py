@@ -0,0 +1,106 @@
+import html
+from urllib.parse import quote_plus
+
+import folium
+from folium.plugins import FastMarkerCluster
+
+# Highlight colours for the three most reviewed places
+TOP_PLACE_COLORS = ['yellow', 'green', 'orange']
+# Above this many places, everything past the top three is rendered as one
+# clustered layer instead of one folium.Marker (and popup) per place
+FAST_MARKERS_THRESHOLD = 100
+
+# Builds each clustered marker from a compact [lat, lng, name, reviews,
+# place_id] row. The popup is only built when it is opened.
+FAST_MARKER_CALLBACK = """
+function (row) {
+    var marker = L.marker(new L.LatLng(row[0], row[1]));
+    // Names are set as text, never parsed as HTML
+    var tooltip = document.createElement('span');
+    tooltip.textContent = row[2] + ' - ' + row[3] + ' reviews';
+    marker.bindTooltip(tooltip);
+    marker.bindPopup(function () {
+        var link = document.createElement('a');
+        link.href = 'https://www.google.com/maps/search/?api=1&query='
+            + encodeURIComponent(row[2]) + '&query_place_id=' + encodeURIComponent(row[4]);
+        link.target = '_blank';
+        link.textContent = row[2];
+        var title = document.createElement('h4');
+        title.appendChild(link);
+        var reviews = document.createElement('p');
+        reviews.textContent = 'Reviews: ' + row[3];
+        var popup = document.createElement('div');
+        popup.style.fontFamily = 'Arial, sans-serif';
+        popup.appendChild(title);
+        popup.appendChild(reviews);
+        return popup;
+    }, {maxWidth: 300});
+    return marker;
+}
+"""
+
+
+def google_maps_link(name, place_id):
+    return (
+        f"https://www.google.com/maps/search/?api=1&"
+        f"query={quote_plus(name or '')}&"
+        f"query_place_id={place_id}"
+    )
+
+
+def marker_rows(table):
+    # (lat, lng, name, reviews, place_id) rows of an Arrow table
+    return list(zip(
+        table['lat'].to_pylist(),
+        table['lng'].to_pylist(),
+        table['name'].to_pylist(),
+        table['user_ratings_total'].to_pylist(),
+        table['place_id'].to_pylist(),
+    ))
+
+
+def add_place_marker(row, map_obj, color):
+    lat, lng, name, reviews, place_id = row
+    escaped_name = html.escape(name or 'N/A')
+
+    # Create the popup HTML with the place name, reviews, and Google Maps link
+    popup_html = f"""
+        <div style='font-family: Arial, sans-serif;'>
+            <h4><a href='{html.escape(google_maps_link(name, place_id))}' target='_blank'>{escaped_name}</a></h4>
+            <p>Reviews: {reviews}</p>
+        </div>
+    """
+
+    # Create a marker with both the popup and a tooltip (visible on hover)
+    tooltip = f"{escaped_name} - {reviews} reviews"
+    folium.Marker(
+        location=[lat, lng],
+        popup=folium.Popup(folium.Html(popup_html, script=True), max_width=300),
+        tooltip=tooltip,
+        icon=folium.Icon(color=color)
+    ).add_to(map_obj)
+
+
+# Function to add place markers to the map
+def add_place_markers(places, map_obj, fast=None):
+    # places is a result_store.PlaceTable; fast=None picks the clustered
+    # layer automatically for large results
+    places = places.filter_located()
+    # Only the top 3 by review count need ranking; the rest keep table order
+    top = places.top_k(len(TOP_PLACE_COLORS), 'user_ratings_total')
+    for row, color in zip(marker_rows(top.table), TOP_PLACE_COLORS):
+        add_place_marker(row, map_obj, color)
+
+    rest = places.exclude(top.column('place_id').to_pylist())
+    if fast is None:
+        fast = len(places) > FAST_MARKERS_THRESHOLD
+    if not fast:
+        for row in marker_rows(rest.table):
+            add_place_marker(row, map_obj, 'blue')
+        return
+
+    if len(rest):
+        FastMarkerCluster(
+            [list(row) for row in marker_rows(rest.table)],
+            callback=FAST_MARKER_CALLBACK, name="Places"
+        ).add_to(map_obj)
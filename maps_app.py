@@ -1,22 +1,71 @@
-import streamlit as st
-import folium
-from streamlit_folium import st_folium
-import requests
-from dotenv import load_dotenv
 import os
+import tempfile
 import time
-from streamlit_geolocation import streamlit_geolocation
-import math
 
-# Load environment variables from .env file
-load_dotenv()
+import streamlit as st
+import streamlit.components.v1 as components
+import pyarrow as pa
+import pyarrow.compute as pc
+
+import tracing
+import warm_start
+from export import EXPORT_FORMATS, export_table
+from coverage_planner import HEX_MAX_CIRCLES, evaluate_coverage, plan_hex_coverage
+from gazetteer import local_gazetteer
+from metrics import METRICS_PORT, render_metrics, start_metrics_server
+from places_api import API_KEY, fetch_place_details
+from ranking import SCORE_COLUMNS
+from refresher import nearby_refresher
+from result_store import PlaceTable
+from spatial_index import PlaceIndex
+from search import (
+    ADAPTIVE_MAX_CALLS, ADAPTIVE_MIN_RADIUS, MAIN_PLACE_TYPES, MAX_PAGES, SEARCH_CALL_BUDGET, CallBudget,
+    RunningResults, build_queries, calculate_grid_points, run_adaptive_search, run_search,
+)
+
+# The map stack (folium, streamlit_folium, streamlit_geolocation) is
+# imported where it is used, so a cold process starts rendering the page
+# while warm_start loads it in the background
+
+# Minimum seconds between redraws of the live results while a search runs
+STREAM_REFRESH_SECONDS = 0.75
 
-# Get API key from environment variables
-API_KEY = os.getenv('GOOGLE_MAPS_API_KEY')
 if not API_KEY:
     st.error("GOOGLE_MAPS_API_KEY environment variable is not set.")
     st.stop()
 
+@st.cache_resource
+def map_stack_preload():
+    # Once per process, before anything else: the first page render then
+    # overlaps with the slowest imports
+    return warm_start.preload_map_stack()
+
+map_stack_preload()
+
+@st.cache_resource
+def metrics_server():
+    # One /metrics endpoint per process, when PLACES_METRICS_PORT is set
+    return start_metrics_server() if METRICS_PORT else None
+
+metrics_server()
+
+@st.cache_resource
+def background_refresher():
+    # Keep the most searched areas fresh in the cache (once per process)
+    nearby_refresher.start()
+    return nearby_refresher
+
+background_refresher()
+
+@st.cache_resource
+def shared_place_index():
+    # Every place fetched by any session, so overlapping searches can be
+    # answered without calling the Places API again. Restored from the
+    # warm-start snapshot on the volume, and saved back periodically.
+    place_index = PlaceIndex()
+    warm_start.keep_snapshots(place_index)
+    return place_index
+
 st.title("Most Reviewed Places Finder")
 
 # Initialize session state for place_query
@@ -26,34 +75,26 @@ if "previous_query" not in st.session_state:
 # Add a text input for the search box
 place_query = st.text_input("Search for a city:", "")
 
-# Function to fetch place details using Google Places API
-def fetch_place_details(query):
-    search_url = (
-        f"https://maps.googleapis.com/maps/api/place/findplacefromtext/json"
-        f"?input={query}&inputtype=textquery&fields=geometry,name&key={API_KEY}"
-    )
-    response = requests.get(search_url)
-    if response.status_code == 200:
-        candidates = response.json().get('candidates', [])
-        if candidates:
-            return candidates[0]  # Return the first matching place
-    return None
-
 # Initialize session state
 if "marker_location" not in st.session_state:
     st.session_state.marker_location = [48.8566, 2.3522]  # Default to Paris
     st.session_state.zoom = 12
+    # The base map never moves, so st_folium does not remount it
+    st.session_state.map_origin = list(st.session_state.marker_location)
 
 # Add to session state initialization at the top
-if "search_results_map" not in st.session_state:
-    st.session_state.search_results_map = None
 if "search_results" not in st.session_state:
-    st.session_state.search_results = []
+    st.session_state.search_results = PlaceTable.empty()
+    st.session_state.search_area = None
+    st.session_state.search_id = 0
+if "last_click" not in st.session_state:
+    st.session_state.last_click = None
 
 # Handle the search query only when it changes
 if place_query and place_query != st.session_state.previous_query:
-    print("place query", place_query)
-    place_details = fetch_place_details(place_query)
+    with tracing.span('geocode', query=place_query) as geocode_span:
+        place_details = fetch_place_details(place_query)
+        geocode_span.set(found=bool(place_details))
     if place_details:
         location = place_details['geometry']['location']
         st.session_state.marker_location = [location['lat'], location['lng']]
@@ -64,6 +105,22 @@ if place_query and place_query != st.session_state.previous_query:
     # Update the previous query
     st.session_state.previous_query = place_query
 
+# Cities matching what was typed (prefix or close spelling), from the
+# local gazetteer; picking one moves the marker without an API call
+if local_gazetteer is not None and place_query:
+    suggestions = {
+        f"{place['name']}, {place['country']}" if place['country'] else place['name']: place
+        for place in local_gazetteer.suggest(place_query)
+    }
+    if suggestions:
+        picked = st.selectbox("Suggestions", list(suggestions), index=None, key=f"suggestions_{place_query}",
+                              placeholder=f"{len(suggestions)} matching cities")
+        if picked and picked != st.session_state.get("picked_suggestion"):
+            place = suggestions[picked]
+            st.session_state.marker_location = [place['lat'], place['lng']]
+            st.session_state.zoom = 15
+            st.session_state.picked_suggestion = picked
+
 # Search settings
 st.subheader("Search Settings")
 
@@ -79,11 +136,44 @@ selected_place_type = st.selectbox("Place Type", options=PLACE_TYPES, index=0)
 # Replace the columns and slider with just the number input
 search_radius = st.number_input("Search Radius (meters)", min_value=100, value=500, help="Enter a radius in meters")
 
-# Add grid search option after the search radius input
-grid_search_enabled = st.checkbox("Enable Grid Search", value=False, help="Enable this to search in a grid pattern for better coverage")
+# Add search pattern option after the search radius input
+SEARCH_PATTERNS = ["Single Circle", "Grid Search", "Hex Coverage", "Adaptive Search"]
+search_pattern = st.radio(
+    "Search Pattern", options=SEARCH_PATTERNS, index=0, horizontal=True,
+    help="Grid Search queries a fixed 3x3 grid. Hex Coverage covers the circle (or an area drawn "
+         "on the map) with the fewest query circles. Adaptive Search starts from the whole circle "
+         "and only splits areas that returned a full page of results."
+)
+grid_search_enabled = search_pattern == "Grid Search"
+hex_coverage_enabled = search_pattern == "Hex Coverage"
+adaptive_search_enabled = search_pattern == "Adaptive Search"
+if adaptive_search_enabled:
+    col1, col2 = st.columns(2)
+    with col1:
+        adaptive_min_radius = st.number_input("Minimum Cell Radius (meters)", min_value=50, value=ADAPTIVE_MIN_RADIUS)
+    with col2:
+        adaptive_max_calls = st.number_input("API Call Budget", min_value=1, value=ADAPTIVE_MAX_CALLS)
+if hex_coverage_enabled:
+    hex_cell_radius = st.number_input(
+        "Query Circle Radius (meters)", min_value=50, value=max(50, search_radius // 2),
+        help="Radius of each query circle. Smaller circles return fewer capped results but need more calls."
+    )
+
+if "coverage_polygon" not in st.session_state:
+    st.session_state.coverage_polygon = None
 
 # Add this after the grid search checkbox
-fetch_all_pages = st.checkbox("Fetch all available results", value=False, help="When enabled, fetches up to 60 results (3 pages). When disabled, fetches only 20 results (1 page).")
+fetch_all_pages = st.checkbox(
+    "Fetch all available results", value=False, disabled=MAX_PAGES == 1,
+    help=f"When enabled, fetches up to {MAX_PAGES * 20} results ({MAX_PAGES} pages). When disabled, fetches only "
+         "20 results (1 page)." if MAX_PAGES > 1 else "The configured Places backend returns a single page of 20 results."
+)
+if not adaptive_search_enabled:
+    call_budget = st.number_input(
+        "API Call Budget per Search", min_value=1, value=SEARCH_CALL_BUDGET,
+        help="Past this many Places API calls a search stops fetching extra pages, "
+             "then leaves out the outermost query circles."
+    )
 
 # Calculate appropriate zoom level based on radius
 # These values are approximate and can be adjusted
@@ -103,6 +193,7 @@ else:
 # Add geolocation button
 col1, col2 = st.columns([1, 3])
 with col1:
+    from streamlit_geolocation import streamlit_geolocation
     location = streamlit_geolocation()
 with col2:
     st.markdown("👈 Click to use your current location")
@@ -111,182 +202,165 @@ if location and location['latitude'] is not None and location['longitude'] is no
     st.session_state.marker_location = [location['latitude'], location['longitude']]
     st.session_state.zoom = 15
 
-# Add this function before the fetch_nearby_places function
-def calculate_grid_points(center, radius):
-    lat, lng = center
-    # Calculate offsets for a 3x3 grid
-    # Adjust spacing to 0.4 (up from 0.33) for slightly larger coverage
-    lat_offset = (radius * 0.00001) * 0.5  # Increased spacing
-    lng_offset = (radius * 0.00001 / math.cos(math.radians(lat))) * 0.5  # Adjusted for longitude distortion
-    
-    grid_points = []
-    for i in range(-1, 2):  # -1, 0, 1
-        for j in range(-1, 2):  # -1, 0, 1
-            grid_points.append([
-                lat + (i * lat_offset),
-                lng + (j * lng_offset)
-            ])
-    return grid_points
-
-# Update the create_base_map function
-def create_base_map():
-    m = folium.Map(location=st.session_state.marker_location, zoom_start=st.session_state.zoom)
-    
+@st.cache_data(max_entries=64)
+def cached_coverage_plan(center, radius, cell_radius, polygon):
+    return plan_hex_coverage(list(center), radius, cell_radius, polygon=[list(p) for p in polygon] if polygon else None)
+
+# Plan the hexagonal query circles for the current area
+def current_coverage_plan():
+    if not hex_coverage_enabled:
+        return None
+    polygon = st.session_state.coverage_polygon
+    return cached_coverage_plan(
+        tuple(st.session_state.marker_location), search_radius, hex_cell_radius,
+        tuple(tuple(p) for p in polygon) if polygon else None,
+    )
+
+# Base map shared by both map views. It is rebuilt on every run but always
+# comes out the same, so st_folium keeps the mounted map; the view moves
+# through st_folium's center/zoom and the content comes in feature groups.
+def create_base_map(draw=False):
+    import folium
+    from folium.plugins import Draw
+
+    m = folium.Map(location=st.session_state.map_origin, zoom_start=12)
+    if draw:
+        # A polygon drawn with the toolbar replaces the search circle as the
+        # area to cover in Hex Coverage mode
+        Draw(
+            draw_options={'polyline': False, 'circle': False, 'circlemarker': False, 'marker': False},
+            edit_options={'edit': False},
+        ).add_to(m)
+    return m
+
+def search_area_circles(search_tree=None):
+    # Circles showing the area a search covers, as plain dicts that can live
+    # in session state
+    center = st.session_state.marker_location
+    if search_tree:
+        # Display the cells an adaptive search actually queried, red where
+        # the cell was saturated and got split further
+        return [
+            {
+                'location': node['center'],
+                'radius': node['radius'],
+                'color': "red" if node['saturated_types'] else "blue",
+                'weight': 1,
+                'fill_opacity': 0.05,
+                'tooltip': f"Depth {node['depth']}: {node['result_count']} results",
+            }
+            for node in search_tree
+        ]
+    coverage_plan = current_coverage_plan()
+    if coverage_plan:
+        # Display the planned query circles
+        return [
+            {'location': point, 'radius': coverage_plan['cell_radius'], 'color': "blue", 'weight': 1}
+            for point in coverage_plan['points']
+        ]
+    if grid_search_enabled:
+        # Display 3x3 grid
+        return [
+            {'location': point, 'radius': search_radius * 0.5, 'color': "blue"}
+            for point in calculate_grid_points(center, search_radius)
+        ]
+    # Display single circle
+    return [{'location': center, 'radius': search_radius, 'color': "blue"}]
+
+def create_search_layer(center, circles, polygon=None):
+    import folium
+
+    layer = folium.FeatureGroup(name="Search area")
+
     # Add center marker
     folium.Marker(
-        location=st.session_state.marker_location,
+        location=center,
         draggable=False,
         icon=folium.Icon(color="red", icon="info-sign"),
-    ).add_to(m)
-    
-    if grid_search_enabled:
-        # Display 3x3 grid
-        grid_points = calculate_grid_points(st.session_state.marker_location, search_radius)
-        
-        # Create grid cells with slightly larger radius
-        for point in grid_points:
-            folium.Circle(
-                location=point,
-                radius=search_radius * 0.5,  # Increased from 0.33 to 0.4
-                color="blue",
-                fill=True,
-                fillColor="blue",
-                fillOpacity=0.1
-            ).add_to(m)
-    else:
-        # Display single circle
+    ).add_to(layer)
+
+    for circle in circles:
         folium.Circle(
-            location=st.session_state.marker_location,
-            radius=search_radius,
-            color="blue",
+            location=circle['location'],
+            radius=circle['radius'],
+            color=circle['color'],
+            weight=circle.get('weight', 3),
             fill=True,
-            fillColor="blue",
-            fillOpacity=0.1
-        ).add_to(m)
-    
-    return m
-
-# Function to add place markers to the map
-def add_place_markers(places, map_obj, limit=None):
-    # Sort places by review count to identify top 3
-    sorted_places = sorted(places, key=lambda x: x.get('user_ratings_total', 0), reverse=True)
-    
-    for i, place in enumerate(sorted_places):
-        if 'geometry' in place and 'location' in place['geometry']:
-            location = place['geometry']['location']
-            
-            # Create the popup HTML with the place name, reviews, and Google Maps link
-            google_maps_link = (
-                f"https://www.google.com/maps/search/?api=1&"
-                f"query={place['name'].replace(' ', '+')}&"
-                f"query_place_id={place['place_id']}"
-            )
-            
-            popup_html = f"""
-                <div style='font-family: Arial, sans-serif;'>
-                    <h4><a href='{google_maps_link}' target='_blank'>{place.get('name', 'N/A')}</a></h4>
-                    <p>Reviews: {place.get('user_ratings_total', 0)}</p>
-                </div>
-            """
-            
-            # Create a Popup object with the HTML content
-            popup = folium.Popup(folium.Html(popup_html, script=True), max_width=300)
-            
-            # Set color based on ranking
-            if i == 0:
-                color = 'yellow'  # First place
-            elif i == 1:
-                color = 'green'   # Second place
-            elif i == 2:
-                color = 'orange'  # Third place
+            fillColor=circle['color'],
+            fillOpacity=circle.get('fill_opacity', 0.1),
+            tooltip=circle.get('tooltip'),
+        ).add_to(layer)
+    if polygon:
+        folium.Polygon(polygon, color="red", fill=False).add_to(layer)
+    return layer
+
+@st.fragment
+def selection_map():
+    # Clicks and drawings on this map only rerun this fragment. They are read
+    # from the map's widget state before it renders, so the marker moves in
+    # the same run instead of through an extra st.rerun().
+    from streamlit_folium import st_folium
+
+    map_state = st.session_state.get("selection_map") or {}
+    clicked = map_state.get("last_clicked")
+    if clicked and clicked != st.session_state.last_click:
+        st.session_state.last_click = clicked
+        st.session_state.marker_location = [clicked["lat"], clicked["lng"]]
+
+    # Use a polygon or rectangle drawn in Hex Coverage mode as the area to cover
+    # (st_folium keeps returning the last drawing, so only react to new ones)
+    drawing = map_state.get("last_active_drawing")
+    if (hex_coverage_enabled and drawing and drawing != st.session_state.get("last_drawing")
+            and drawing.get("geometry", {}).get("type") == "Polygon"):
+        st.session_state.last_drawing = drawing
+        # GeoJSON rings are [lng, lat] and repeat the first vertex at the end
+        st.session_state.coverage_polygon = [[lat, lng] for lng, lat in drawing["geometry"]["coordinates"][0][:-1]]
+
+    if hex_coverage_enabled:
+        if st.session_state.coverage_polygon:
+            if st.button("Clear drawn area"):
+                st.session_state.coverage_polygon = None
             else:
-                color = 'blue'    # All other places
-            
-            # Create a marker with both the popup and a tooltip (visible on hover)
-            tooltip = f"{place.get('name', 'N/A')} - {place.get('user_ratings_total', 0)} reviews"
-            folium.Marker(
-                location=[location['lat'], location['lng']],
-                popup=popup,
-                tooltip=tooltip,
-                icon=folium.Icon(color=color)
-            ).add_to(map_obj)
-
-# Initialize the map
-m = create_base_map()
-
-# Display coordinates
-st.write(f"Selected Coordinates: {st.session_state.marker_location}")
-
-# Render the map
-map_data = st_folium(m, width=300, height=300)
-
-# Initialize session state for map clicks
-if "map_clicked" not in st.session_state:
-    st.session_state.map_clicked = False
-
-# Map click handling
-if map_data.get("last_clicked") and not st.session_state.map_clicked:
-    print("last clicked", map_data["last_clicked"])
-    lat, lng = map_data["last_clicked"]["lat"], map_data["last_clicked"]["lng"]
-    if [lat, lng] != st.session_state.marker_location:  # Only rerun if location actually changed
-        st.session_state.marker_location = [lat, lng]
-        st.session_state.zoom = map_data["zoom"]
-        st.session_state.map_clicked = True
-        print('rerunning')
-        st.rerun()
-
-# Reset map_clicked state after the rerun
-if st.session_state.map_clicked:
-    st.session_state.map_clicked = False
-
-def fetch_nearby_places(location, radius=2500, place_type='restaurant'):
-    all_results = []
-    search_url = (
-        f"https://maps.googleapis.com/maps/api/place/nearbysearch/json"
-        f"?location={location}&radius={radius}&type={place_type}&key={API_KEY}"
+                st.caption("Covering the area drawn on the map.")
+        if not st.session_state.coverage_polygon:
+            # Compare against the 3x3 grid, which queries every point at the full radius
+            grid_points = calculate_grid_points(st.session_state.marker_location, search_radius)
+            grid_coverage = evaluate_coverage(st.session_state.marker_location, search_radius, grid_points, search_radius)
+            st.caption(
+                f"3x3 grid: {len(grid_points)} calls per category, "
+                f"{grid_coverage['coverage_ratio']:.0%} coverage, overlap x{grid_coverage['overlap_factor']:.2f}"
+            )
+        coverage_plan = current_coverage_plan()
+        st.caption(
+            f"Hex plan: {len(coverage_plan['points'])} calls per category, "
+            f"{coverage_plan['coverage_ratio']:.0%} coverage, overlap x{coverage_plan['overlap_factor']:.2f}"
+        )
+        if coverage_plan['clamped']:
+            st.caption(
+                f"Query circle radius raised to {coverage_plan['cell_radius']:.0f} m "
+                f"to keep the plan under {HEX_MAX_CIRCLES} circles."
+            )
+
+    # Display coordinates
+    st.write(f"Selected Coordinates: {st.session_state.marker_location}")
+
+    # Render the map
+    st_folium(
+        create_base_map(draw=hex_coverage_enabled),
+        key="selection_map",
+        width=300,
+        height=300,
+        center=st.session_state.marker_location,
+        zoom=st.session_state.zoom,
+        feature_group_to_add=create_search_layer(
+            st.session_state.marker_location, search_area_circles(),
+            polygon=st.session_state.coverage_polygon if hex_coverage_enabled else None,
+        ),
+        returned_objects=["last_clicked", "last_active_drawing"],
     )
-    
-    # Fetch first page
-    response = requests.get(search_url)
-    if response.status_code != 200:
-        st.error("Error fetching data from Google Places API.")
-        return []
-    
-    first_page = response.json()
-    all_results.extend(first_page.get('results', []))
-    
-    # Only fetch additional pages if the option is enabled
-    if fetch_all_pages:
-        # Fetch up to 2 more pages using pagetoken
-        for _ in range(2):  # Try to get 2 more pages
-            next_page_token = first_page.get('next_page_token')
-            if not next_page_token:
-                break
-                
-            # Wait for token to become valid (Google requires a delay)
-            time.sleep(2)
-            
-            next_page_url = f"{search_url}&pagetoken={next_page_token}"
-            response = requests.get(next_page_url)
-            if response.status_code == 200:
-                first_page = response.json()
-                all_results.extend(first_page.get('results', []))
-    
-    # Debugging: Print the latitude and longitude of each fetched place
-    for place in all_results:
-        if 'geometry' in place and 'location' in place['geometry']:
-            location = place['geometry']['location']
-            print(f"Fetched place: {place.get('name', 'N/A')} at "
-                  f"Latitude: {location.get('lat', 'N/A')}, "
-                  f"Longitude: {location.get('lng', 'N/A')}")
-    
-    return all_results
-
-
-# Add this after the existing place types list
-MAIN_PLACE_TYPES = [
-    'restaurant', 'bar', 'cafe', 'tourist_attraction', 'museum'
-]
+    warm_start.first_map_rendered()
+
+selection_map()
 
 PLACE_TYPE_COLORS = {
     'restaurant': '#FF0000',     # Red
@@ -301,76 +375,315 @@ PLACE_TYPE_COLORS = {
     'other': '#808080'          # Gray for uncategorized places
 }
 
+def planned_queries(place_types, budget):
+    # The queries a non-adaptive search will send, fitted to the budget.
+    # Queries the place index already covers cost nothing and are always kept.
+    radius = search_radius
+    coverage_plan = current_coverage_plan()
+    if coverage_plan:
+        points = coverage_plan['points']
+        radius = round(coverage_plan['cell_radius'])
+    elif grid_search_enabled:
+        points = calculate_grid_points(st.session_state.marker_location, search_radius)
+    else:
+        points = [st.session_state.marker_location]
+    queries = build_queries(points, radius, place_types)
+    local, remote = shared_place_index().split_queries(queries)
+    kept = set(local) | set(budget.fit(remote, st.session_state.marker_location))
+    return [query for query in queries if query in kept], local, remote
+
+def search_places(place_types, on_page=None):
+    # Run a search with the selected pattern; returns (places, errors, search tree)
+    place_index = shared_place_index()
+    st.session_state.local_queries = None
+    st.session_state.search_budget = None
+    if adaptive_search_enabled:
+        # Every level of the quadtree spends from one budget
+        budget = CallBudget(adaptive_max_calls)
+        st.session_state.search_budget = budget
+        return run_adaptive_search(
+            st.session_state.marker_location, search_radius, place_types,
+            fetch_all_pages=fetch_all_pages, min_radius=adaptive_min_radius,
+            place_index=place_index, on_page=on_page, budget=budget,
+        )
+    budget = CallBudget(call_budget)
+    queries, local, _ = planned_queries(place_types, budget)
+    st.session_state.local_queries = (len(local), len(queries))
+    st.session_state.search_budget = budget
+    results, errors = run_search(
+        queries, fetch_all_pages=fetch_all_pages, place_index=place_index, on_page=on_page,
+        budget=budget,
+    )
+    return results, errors, None
+
+def cost_estimate(place_types):
+    # "a-b calls" a search of these types would make right now
+    if adaptive_search_enabled:
+        # The budget caps every page and token retry of every level
+        return f"up to {adaptive_max_calls} calls"
+    budget = CallBudget(call_budget)
+    _, _, remote = planned_queries(place_types, budget)
+    fewest, most = budget.estimate(remote, fetch_all_pages)
+    estimate = f"{fewest} calls" if fewest == most else f"{fewest}-{most} calls"
+    if budget.queries_dropped:
+        estimate += f" ({budget.queries_dropped} queries over budget left out)"
+    return estimate
+
+def stream_search(place_types):
+    # Run a search, drawing the places found so far on a live map and list
+    # as pages arrive instead of waiting for the whole search to finish
+    with tracing.span('search', pattern=search_pattern, place_types=place_types,
+                      radius=search_radius, fetch_all_pages=fetch_all_pages) as search_span:
+        st.session_state.last_trace = search_span
+        places, errors, search_tree = _stream_search(place_types)
+        search_span.set(result_count=len(places), errors=len(errors))
+    return places, errors, search_tree
+
+def _stream_search(place_types):
+    import folium
+    from map_layers import TOP_PLACE_COLORS, add_place_markers
+
+    running = RunningResults(top_count=len(TOP_PLACE_COLORS))
+    live_status = st.empty()
+    live_map = st.empty()
+    live_list = st.empty()
+    last_redraw = [0.0]
+    pages = [0]
+
+    def on_page(query, results):
+        pages[0] += 1
+        running.add(results, query[2])
+        live_status.caption(f"{len(running.places)} places from {pages[0]} pages so far...")
+        if time.monotonic() - last_redraw[0] < STREAM_REFRESH_SECONDS:
+            return
+        last_redraw[0] = time.monotonic()
+        # A plain HTML map: st_folium can only be drawn once per run
+        live_layer = create_search_layer(st.session_state.marker_location, search_area_circles())
+        add_place_markers(PlaceTable.from_places(running.places), live_layer)
+        m = folium.Map(location=st.session_state.marker_location, zoom_start=st.session_state.zoom)
+        live_layer.add_to(m)
+        with live_map:
+            components.html(m.get_root().render(), height=500)
+        live_list.markdown("\n".join(
+            f"{rank}. **{place.get('name')}**: {place.get('user_ratings_total', 0)} reviews"
+            for rank, place in enumerate(running.top, start=1)
+        ))
+
+    try:
+        return search_places(place_types, on_page=on_page)
+    finally:
+        live_status.empty()
+        live_map.empty()
+        live_list.empty()
+
+def store_results(results, search_tree):
+    # Keep columnar place data and the searched area in session state; the
+    # results map is rebuilt from them when it is displayed
+    st.session_state.search_results = PlaceTable.from_places(results)
+    st.session_state.search_area = {
+        'center': list(st.session_state.marker_location),
+        'zoom': st.session_state.zoom,
+        'circles': search_area_circles(search_tree),
+        'local_queries': st.session_state.local_queries,
+        'budget': st.session_state.search_budget,
+        'adaptive': search_tree is not None,
+    }
+    st.session_state.search_id += 1
+
+st.caption(
+    f"Estimated cost: typeless search {cost_estimate(MAIN_PLACE_TYPES)}, "
+    f"{selected_place_type.replace('_', ' ')} search {cost_estimate([selected_place_type])}."
+)
+
 # Update the Typeless Search button section
 if st.button("Typeless Search"):
-    location_str = f"{st.session_state.marker_location[0]},{st.session_state.marker_location[1]}"
-    all_results = []
-    seen_place_ids = set()
-    
-    with st.spinner('Searching across main categories... This may take a few seconds...'):
-        if grid_search_enabled:
-            grid_points = calculate_grid_points(st.session_state.marker_location, search_radius)
-            for point in grid_points:
-                loc_str = f"{point[0]},{point[1]}"
-                for place_type in MAIN_PLACE_TYPES:
-                    results = fetch_nearby_places(loc_str, radius=search_radius, place_type=place_type)
-                    for result in results:
-                        if result.get('place_id') not in seen_place_ids:
-                            seen_place_ids.add(result.get('place_id'))
-                            result['category'] = place_type
-                            all_results.append(result)
-        else:
-            for place_type in MAIN_PLACE_TYPES:
-                results = fetch_nearby_places(location_str, radius=search_radius, place_type=place_type)
-                for result in results:
-                    if result.get('place_id') not in seen_place_ids:
-                        seen_place_ids.add(result.get('place_id'))
-                        result['category'] = place_type
-                        all_results.append(result)
+    with st.spinner('Searching across main categories in parallel...'):
+        all_results, errors, search_tree = stream_search(MAIN_PLACE_TYPES)
+        if errors:
+            st.error(f"Error fetching data from Google Places API ({len(errors)} requests failed).")
 
         if all_results:
-            # Sort results by review count
-            sorted_results = sorted(all_results, key=lambda x: x.get('user_ratings_total', 0), reverse=True)
-            
-            # Store results in session state
-            st.session_state.search_results = sorted_results
-            
-            # Create results map
-            results_map = create_base_map()
-            add_place_markers(sorted_results, results_map)
-            st.session_state.search_results_map = results_map
+            store_results(all_results, search_tree)
 
 # Move the single place type search here, right after typeless search
 if st.button(f"Search {selected_place_type.replace('_', ' ').title()}s"):
-    location_str = f"{st.session_state.marker_location[0]},{st.session_state.marker_location[1]}"
-    
     with st.spinner(f'Searching for {selected_place_type}s...'):
-        results = fetch_nearby_places(location_str, radius=search_radius, place_type=selected_place_type)
+        results, errors, search_tree = stream_search([selected_place_type])
+        if errors:
+            st.error("Error fetching data from Google Places API.")
         
         if results:
-            sorted_results = sorted(results, key=lambda x: x.get('user_ratings_total', 0), reverse=True)
-            st.session_state.search_results = sorted_results
-            results_map = create_base_map()
-            add_place_markers(sorted_results, results_map)
-            st.session_state.search_results_map = results_map
+            store_results(results, search_tree)
 
 # Display the results map right after the search buttons
-if st.session_state.search_results_map:
+if len(st.session_state.search_results):
+    from map_layers import add_place_markers
+    from streamlit_folium import st_folium
+
     st.subheader("Results Map")
-    st_folium(st.session_state.search_results_map, width=700, height=500)
+    search_area = st.session_state.search_area
+    results_layer = create_search_layer(search_area['center'], search_area['circles'])
+    add_place_markers(st.session_state.search_results, results_layer)
+    # A new key per search mounts a fresh map for new results; panning or
+    # zooming it returns nothing, so it never triggers a rerun
+    st_folium(
+        create_base_map(),
+        key=f"results_map_{st.session_state.search_id}",
+        width=700,
+        height=500,
+        center=search_area['center'],
+        zoom=search_area['zoom'],
+        feature_group_to_add=results_layer,
+        returned_objects=[],
+    )
+    local, total = search_area['local_queries'] or (0, 0)
+    if local:
+        st.caption(f"{local} of {total} area/category queries answered from places already fetched")
+    budget = search_area['budget']
+    if budget is not None:
+        st.caption(f"{budget.spent} of {budget.limit} budgeted API calls used")
+        if budget.pages_dropped or budget.cells_dropped:
+            left_out = "split cells" if search_area['adaptive'] else "outer query circles"
+            st.warning(
+                f"Call budget reached: skipped extra pages for {budget.pages_dropped} queries "
+                f"and left out {budget.cells_dropped} {left_out}."
+            )
 
-# Display results list last
-if st.session_state.search_results:
+# Rows per page of the results list
+RESULTS_PAGE_SIZE = 50
+# Sort choices of the results list: label -> column
+SORT_COLUMNS = {label: column for column, label in SCORE_COLUMNS.items()}
+SORT_COLUMNS["Rating"] = 'rating'
+
+@st.fragment
+def results_list():
+    # One dataframe for the whole list; filtering and paging only rerun
+    # this fragment and only the current page is sent to the browser
+    from map_layers import google_maps_link
+
+    results = st.session_state.search_results
     st.subheader("Places Found:")
-    for place in st.session_state.search_results:
-        st.markdown(f"### {place.get('name')}")
-        st.write(f"**Rating:** {place.get('rating', 'N/A')} stars")
-        st.write(f"**Reviews:** {place.get('user_ratings_total', 0)}")
-        if 'place_id' in place:
-            google_maps_link = (
-                f"https://www.google.com/maps/search/?api=1&"
-                f"query={place['name'].replace(' ', '+')}&"
-                f"query_place_id={place['place_id']}"
-            )
-            st.markdown(f"[View on Google Maps]({google_maps_link})")
-        st.write("---")
+    col1, col2, col3, col4 = st.columns(4)
+    with col1:
+        categories = results.column('categories').combine_chunks().cast(pa.list_(pa.string()))
+        category = st.selectbox("Category", ["All"] + sorted(pc.unique(pc.list_flatten(categories)).to_pylist()))
+    with col2:
+        min_rating = st.slider("Minimum rating", 0.0, 5.0, 0.0, 0.5)
+    with col3:
+        min_reviews = st.number_input("Minimum reviews", min_value=0, value=0, step=10)
+    with col4:
+        sort_label = st.selectbox("Sort by", list(SORT_COLUMNS))
+    filtered = results.filter(
+        category=None if category == "All" else category,
+        min_rating=min_rating or None,
+        min_reviews=min_reviews or None,
+    )
+    page_count = max(1, -(-len(filtered) // RESULTS_PAGE_SIZE))
+    page = st.number_input("Page", min_value=1, max_value=page_count, value=1) if page_count > 1 else 1
+    # Rank only as far as the page on screen, over the whole filtered table
+    ranked = filtered.top_k(page * RESULTS_PAGE_SIZE, SORT_COLUMNS[sort_label])
+    rows = ranked.table.slice((page - 1) * RESULTS_PAGE_SIZE, RESULTS_PAGE_SIZE)
+    names = rows['name'].to_pylist()
+    st.dataframe(
+        {
+            'Name': names,
+            'Rating': rows['rating'].to_pylist(),
+            'Reviews': rows['user_ratings_total'].to_pylist(),
+            'Categories': [", ".join(categories) for categories in rows['categories'].to_pylist()],
+            'Adjusted rating': rows['bayes_rating'].to_pylist(),
+            'Google Maps': [
+                google_maps_link(name, place_id) if place_id else None
+                for name, place_id in zip(names, rows['place_id'].to_pylist())
+            ],
+        },
+        column_config={
+            'Rating': st.column_config.NumberColumn(format="%.1f ⭐"),
+            'Adjusted rating': st.column_config.NumberColumn(
+                format="%.2f", help="Rating pulled towards the average for places with few reviews"),
+            'Google Maps': st.column_config.LinkColumn(display_text="View on Google Maps"),
+        },
+        hide_index=True,
+        use_container_width=True,
+    )
+    st.caption(
+        f"{len(filtered)} of {len(results)} places, page {page} of {page_count}, "
+        f"{results.nbytes / 1024:.0f} KB held for this session"
+    )
+
+    # Export of every filtered place (not just this page) in the chosen
+    # order, written a chunk at a time to a temporary file on disk. Only its
+    # path stays in session state; the file is deleted once downloaded or
+    # replaced by the next export.
+    col1, col2 = st.columns([1, 3])
+    with col1:
+        export_format = st.selectbox("Export format", list(EXPORT_FORMATS), label_visibility="collapsed")
+    export_id = (st.session_state.search_id, category, min_rating, min_reviews, sort_label, export_format)
+    extension, mime = EXPORT_FORMATS[export_format]
+    with col2:
+        if st.session_state.get("export_id") != export_id and st.button(f"Export {len(filtered)} places"):
+            discard_export()
+            with tempfile.NamedTemporaryFile(suffix=extension, delete=False) as f:
+                export_table(filtered.sort_by(SORT_COLUMNS[sort_label]).table, export_format, f)
+            st.session_state.export_path = f.name
+            st.session_state.export_id = export_id
+        if st.session_state.get("export_id") == export_id:
+            with open(st.session_state.export_path, 'rb') as f:
+                st.download_button(
+                    f"Download {len(filtered)} places", f,
+                    file_name=f"places{extension}", mime=mime, on_click=discard_export,
+                )
+
+def discard_export():
+    # Delete the last export file of this session, if any
+    path = st.session_state.get("export_path")
+    st.session_state.export_path = None
+    st.session_state.export_id = None
+    if path:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+# Display results list last
+if len(st.session_state.search_results):
+    results_list()
+
+def trace_rows(root):
+    # One row per span of a search trace, indented by depth
+    rows = []
+    for depth, span in root.walk():
+        attributes = span.attributes
+        rows.append({
+            'Span': "\u2003" * depth + span.name,
+            'ms': round(span.seconds * 1000, 1) if span.seconds is not None else None,
+            'Status': attributes.get('status', attributes.get('http_status')),
+            'Results': attributes.get('result_count'),
+            'Cache hit': attributes.get('cache_hit'),
+            'Bytes': attributes.get('bytes'),
+            'Detail': ", ".join(
+                f"{key}={value}" for key, value in attributes.items()
+                if key in ('location', 'place_type', 'page_index', 'attempt', 'retries', 'coalesced', 'local',
+                           'parse_seconds', 'error')
+            ),
+        })
+    return rows
+
+# Tracing of the last search and process-wide metrics, for debugging
+with st.expander("Debug: last search trace and metrics"):
+    if st.session_state.get("last_trace") is not None:
+        st.dataframe(trace_rows(st.session_state.last_trace), hide_index=True, use_container_width=True)
+    else:
+        st.caption("No search run in this session yet.")
+    refresher_stats = nearby_refresher.stats()
+    st.caption(
+        f"Cached pages served: {refresher_stats['served']}, mean age "
+        f"{refresher_stats['mean_age_seconds'] / 60:.0f} min, max "
+        f"{refresher_stats['max_age_seconds'] / 60:.0f} min; {refresher_stats['refreshes']} background "
+        f"refreshes ({refresher_stats['refresh_calls']} calls) over {refresher_stats['tracked']} tracked queries."
+    )
+    startup = warm_start.startup_stats()
+    if startup:
+        st.caption("Cold start: " + ", ".join(
+            f"{phase.replace('_', ' ')} {seconds:.2f}s" for phase, seconds in startup.items()
+        ))
+    st.code(render_metrics(), language="text")
@@ -1,17 +1,29 @@
+import time
+
 import streamlit as st
 import folium
+from branca.colormap import LinearColormap
+from folium.plugins import HeatMap
 from streamlit_folium import st_folium
-import requests
-from dotenv import load_dotenv
-import os
 from streamlit_geolocation import streamlit_geolocation
-import math
 
-# Load environment variables from .env file
-load_dotenv()
+import tracing
+from places_api import API_KEY, fetch_place_details
+from search import MAX_PAGES, PAGE_SIZE, build_queries, calculate_grid_points, dedupe_places, run_queries
+
+# Profiling view for tuning the grid: every query circle is coloured by its
+# upstream latency, result count or whether it hit the page cap, fetched
+# places are drawn as a density heatmap, and each run adds a row to a
+# summary table (calls, bytes, duplicates, wall time) to compare settings.
+
+# Default grid spacing used by this debug view (the main app uses 0.5)
+GRID_SPACING = 0.75
+# Colour scales of the circle overlays (low to high)
+LATENCY_COLORS = ['#1a9850', '#fee08b', '#d73027']
+RESULT_COLORS = ['#f7fbff', '#6baed6', '#08306b']
+CAPPED_COLOR = '#d73027'
+UNCAPPED_COLOR = '#1a9850'
 
-# Get API key from environment variables
-API_KEY = os.getenv('GOOGLE_MAPS_API_KEY')
 if not API_KEY:
     st.error("GOOGLE_MAPS_API_KEY environment variable is not set.")
     st.stop()
@@ -25,23 +37,13 @@ if "previous_query" not in st.session_state:
 # Add a text input for the search box
 place_query = st.text_input("Search for a city:", "")
 
-# Function to fetch place details using Google Places API
-def fetch_place_details(query):
-    search_url = (
-        f"https://maps.googleapis.com/maps/api/place/findplacefromtext/json"
-        f"?input={query}&inputtype=textquery&fields=geometry,name&key={API_KEY}"
-    )
-    response = requests.get(search_url)
-    if response.status_code == 200:
-        candidates = response.json().get('candidates', [])
-        if candidates:
-            return candidates[0]  # Return the first matching place
-    return None
-
 # Initialize session state
 if "marker_location" not in st.session_state:
     st.session_state.marker_location = [48.8566, 2.3522]  # Default to Paris
     st.session_state.zoom = 12
+if "profile" not in st.session_state:
+    st.session_state.profile = None
+    st.session_state.profile_runs = []
 
 # Handle the search query only when it changes
 if place_query and place_query != st.session_state.previous_query:
@@ -59,7 +61,7 @@ if place_query and place_query != st.session_state.previous_query:
 # Search settings
 st.subheader("Search Settings")
 PLACE_TYPES = [
-    'restaurant', 'bar', 'cafe', 'tourist_attraction', 
+    'restaurant', 'bar', 'cafe', 'tourist_attraction',
     'museum', 'art_gallery', 'church', 'park',
     'historical_landmark', 'night_club', 'tourism'
 ]
@@ -75,6 +77,24 @@ search_radius = manual_radius if manual_radius != search_radius else search_radi
 
 # Add grid search option
 grid_search_enabled = st.checkbox("Enable Grid Search", value=False, help="Enable this to search in a grid pattern for better coverage")
+if grid_search_enabled:
+    col1, col2 = st.columns(2)
+    with col1:
+        grid_spacing = st.slider(
+            "Grid spacing factor", min_value=0.25, max_value=1.5, value=GRID_SPACING, step=0.05,
+            help="Distance between neighbouring grid points, as a fraction of the search radius"
+        )
+    with col2:
+        query_radius_factor = st.slider(
+            "Query radius factor", min_value=0.25, max_value=1.0, value=1.0, step=0.05,
+            help="Radius of each grid query, as a fraction of the search radius"
+        )
+else:
+    grid_spacing, query_radius_factor = GRID_SPACING, 1.0
+fetch_all_pages = st.checkbox(
+    "Fetch all available results", value=False, disabled=MAX_PAGES == 1,
+    help="A query is capped when it fills every page it may fetch"
+)
 
 # Add geolocation button
 col1, col2 = st.columns([1, 3])
@@ -87,35 +107,114 @@ if location and location['latitude'] is not None and location['longitude'] is no
     st.session_state.marker_location = [location['latitude'], location['longitude']]
     st.session_state.zoom = 15
 
-# Function to fetch nearby places
-def fetch_nearby_places(location, radius=2500, place_type='restaurant'):
-    search_url = (
-        f"https://maps.googleapis.com/maps/api/place/nearbysearch/json"
-        f"?location={location}&radius={radius}&type={place_type}&key={API_KEY}"
-    )
-    response = requests.get(search_url)
-    if response.status_code == 200:
-        return response.json().get('results', [])
+
+def planned_queries():
+    if grid_search_enabled:
+        points = calculate_grid_points(st.session_state.marker_location, search_radius, grid_spacing)
     else:
-        st.error("Error fetching data from Google Places API.")
-        return []
-
-# Function to calculate grid points for a 3x3 grid
-def calculate_grid_points(center, radius):
-    lat, lng = center
-    # Calculate offsets for a 3x3 grid
-    # Reduce the spacing between points to 3/4 of the radius to ensure overlap
-    lat_offset = (radius * 0.00001) * 0.75  # Reduced spacing
-    lng_offset = (radius * 0.00001 / math.cos(math.radians(lat))) * 0.75  # Adjusted for longitude distortion
-    
-    grid_points = []
-    for i in range(-1, 2):  # -1, 0, 1
-        for j in range(-1, 2):  # -1, 0, 1
-            grid_points.append([
-                lat + (i * lat_offset),
-                lng + (j * lng_offset)
-            ])
-    return grid_points
+        points = [st.session_state.marker_location]
+    return build_queries(points, round(search_radius * query_radius_factor), [selected_place_type])
+
+
+def query_profiles(root):
+    # {(location, place type): upstream cost of that query} from a search trace
+    profiles = {}
+    for cell in root.children:
+        for query_span in cell.children:
+            pages = [span for _, span in query_span.walk() if span.name == 'page']
+            live = [page for page in pages if not page.attributes.get('cache_hit')]
+            profiles[(cell.attributes.get('location'), query_span.attributes.get('place_type'))] = {
+                'calls': len(live) + sum(page.attributes.get('retries', 0) for page in live),
+                'cache_hits': len(pages) - len(live),
+                'bytes': sum(page.attributes.get('bytes', 0) for page in live),
+                'latency': sum(page.attributes.get('http_seconds', 0.0) for page in live),
+                'wall_seconds': query_span.seconds or 0.0,
+            }
+    return profiles
+
+
+def profile_search(queries, on_progress):
+    # Run the queries inside a trace and fold it into per-circle rows and a
+    # summary of the run
+    started = time.perf_counter()
+    with tracing.span('search', pattern='debug grid' if grid_search_enabled else 'debug single',
+                      place_types=[selected_place_type], radius=search_radius) as root:
+        results_per_query, errors = run_queries(queries, fetch_all_pages, on_progress=on_progress)
+        places = dedupe_places(queries, results_per_query)
+    wall_seconds = time.perf_counter() - started
+    profiles = query_profiles(root)
+    page_cap = PAGE_SIZE * (MAX_PAGES if fetch_all_pages else 1)
+    circles = []
+    for query, results in zip(queries, results_per_query):
+        location, radius, place_type = query
+        circles.append({
+            'location': [float(value) for value in location.split(',')],
+            'radius': radius,
+            'results': len(results),
+            'capped': len(results) >= page_cap,
+            **profiles.get((location, place_type), {
+                'calls': 0, 'cache_hits': 0, 'bytes': 0, 'latency': 0.0, 'wall_seconds': 0.0,
+            }),
+        })
+    returned = sum(len(results) for results in results_per_query)
+    summary = {
+        'Run': len(st.session_state.profile_runs) + 1,
+        'Grid': f"{grid_spacing:.2f} / {query_radius_factor:.2f}" if grid_search_enabled else "single",
+        'Queries': len(queries),
+        'Calls': sum(circle['calls'] for circle in circles),
+        'Cache hits': sum(circle['cache_hits'] for circle in circles),
+        'KB': round(sum(circle['bytes'] for circle in circles) / 1024, 1),
+        'Returned': returned,
+        'Unique places': len(places),
+        'Duplicates discarded': returned - len(places),
+        'Capped queries': sum(circle['capped'] for circle in circles),
+        'Errors': len(errors),
+        'Wall s': round(wall_seconds, 2),
+    }
+    return {'circles': circles, 'places': places, 'errors': errors, 'summary': summary}
+
+
+def add_profile_layers(m, profile, color_by):
+    # Query circles coloured by the chosen measure, a heatmap of the fetched
+    # places, and the matching legend
+    circles = profile['circles']
+    if color_by == "Page cap":
+        colormap = None
+    else:
+        field, colors, caption = (
+            ('latency', LATENCY_COLORS, "Upstream latency (s)") if color_by == "Latency"
+            else ('results', RESULT_COLORS, "Results returned")
+        )
+        values = [circle[field] for circle in circles]
+        colormap = LinearColormap(colors, vmin=min(values), vmax=max(max(values), min(values) + 1e-9),
+                                  caption=caption)
+        colormap.add_to(m)
+    for circle in circles:
+        if colormap is None:
+            color = CAPPED_COLOR if circle['capped'] else UNCAPPED_COLOR
+        else:
+            color = colormap(circle['latency'] if color_by == "Latency" else circle['results'])
+        folium.Circle(
+            location=circle['location'],
+            radius=circle['radius'],
+            color=color,
+            weight=2,
+            fill=True,
+            fillColor=color,
+            fillOpacity=0.35,
+            tooltip=(
+                f"{circle['results']} results{' (capped)' if circle['capped'] else ''}, "
+                f"{circle['calls']} calls, {circle['latency']:.2f}s upstream, "
+                f"{circle['bytes'] / 1024:.1f} KB"
+            ),
+        ).add_to(m)
+    points = [
+        [place['geometry']['location']['lat'], place['geometry']['location']['lng']]
+        for place in profile['places'] if place.get('geometry', {}).get('location')
+    ]
+    if points:
+        HeatMap(points, name="Place density", radius=18, blur=15).add_to(m)
+
 
 # Create the map outside of the search button condition
 m = folium.Map(location=st.session_state.marker_location, zoom_start=st.session_state.zoom)
@@ -127,109 +226,71 @@ folium.Marker(
     icon=folium.Icon(color="red", icon="info-sign"),
 ).add_to(m)
 
-if grid_search_enabled:
-    # Display 3x3 grid
-    grid_points = calculate_grid_points(st.session_state.marker_location, search_radius)
-    
-    # Create grid cells with larger radius for better overlap
-    for point in grid_points:
+# Search and profile
+if st.button(f"Search {selected_place_type.replace('_', ' ').title()}s"):
+    with st.spinner(f'Searching for {selected_place_type.replace("_", " ")}s... Please wait.'):
+        queries = planned_queries()
+
+        progress_text = "Making API requests..."
+        progress_bar = st.progress(0, text=progress_text)
+
+        def update_progress(done, total):
+            progress_bar.progress(done / total, text=f"{progress_text} ({done}/{total})")
+
+        # Grid points are queried concurrently; duplicates are dropped in grid order
+        profile = profile_search(queries, update_progress)
+        progress_bar.empty()  # Remove the progress bar when done
+        st.session_state.profile = profile
+        st.session_state.profile_runs.append(profile['summary'])
+
+profile = st.session_state.profile
+if profile is not None:
+    color_by = st.radio("Colour query circles by", ["Latency", "Results", "Page cap"], horizontal=True)
+    add_profile_layers(m, profile, color_by)
+else:
+    # Planned circles, drawn at their query radius
+    for query in planned_queries():
         folium.Circle(
-            location=point,
-            radius=search_radius * 0.75,  # Increased from 0.5 to 0.75 for better coverage
+            location=[float(value) for value in query[0].split(',')],
+            radius=query[1],
             color="blue",
             fill=True,
             fillColor="blue",
             fillOpacity=0.1
         ).add_to(m)
-else:
-    # Display single circle
-    folium.Circle(
-        location=st.session_state.marker_location,
-        radius=search_radius,
-        color="blue",
-        fill=True,
-        fillColor="blue",
-        fillOpacity=0.1
-    ).add_to(m)
-
-# Search and display results
-if st.button(f"Search {selected_place_type.replace('_', ' ').title()}s"):
-    location_str = f"{st.session_state.marker_location[0]},{st.session_state.marker_location[1]}"
-    with st.spinner(f'Searching for {selected_place_type.replace("_", " ")}s... Please wait.'):
-        all_results = []
-        seen_place_ids = set()  # Track unique places
-        
-        if grid_search_enabled:
-            grid_points = calculate_grid_points(st.session_state.marker_location, search_radius)
-            progress_text = "Making API requests..."
-            progress_bar = st.progress(0, text=progress_text)
-            
-            for idx, point in enumerate(grid_points):
-                loc_str = f"{point[0]},{point[1]}"
-                results = fetch_nearby_places(loc_str, radius=search_radius, place_type=selected_place_type)
-                # Update progress
-                progress = (idx + 1) / len(grid_points)
-                progress_bar.progress(progress, text=f"{progress_text} ({idx + 1}/9)")
-                
-                # Only add unique places
-                for result in results:
-                    if result.get('place_id') not in seen_place_ids:
-                        seen_place_ids.add(result.get('place_id'))
-                        all_results.append(result)
-            
-            progress_bar.empty()  # Remove the progress bar when done
-        else:
-            all_results = fetch_nearby_places(location_str, radius=search_radius, place_type=selected_place_type)
-        
-        if all_results:
-            st.subheader(f"Top {selected_place_type.replace('_', ' ').title()}s Nearby:")
-            places = []
-            
-            # Process and display results
-            for place in all_results:
-                # Extract place details
-                place_location = place.get('geometry', {}).get('location', {})
-                if place_location:
-                    lat, lng = place_location.get('lat'), place_location.get('lng')
-                    name = place.get('name', 'Unknown Place')
-                    rating = place.get('rating', 'N/A')
-                    reviews = place.get('user_ratings_total', 0)
-                    place_id = place.get('place_id', '')
-                    
-                    # Add marker to map
-                    folium.Marker(
-                        location=[lat, lng],
-                        popup=f"{name}<br>Rating: {rating}⭐<br>Reviews: {reviews}",
-                        icon=folium.Icon(color="blue", icon="info-sign"),
-                    ).add_to(m)
-                    
-                    # Store place info for list display
-                    place_info = {
-                        'name': name,
-                        'user_ratings_total': reviews,
-                        'rating': rating,
-                        'place_id': place_id
-                    }
-                    if place_info not in places:
-                        places.append(place_info)
-            
-            # Display sorted list of places
-            sorted_places = sorted(places, key=lambda x: x['user_ratings_total'], reverse=True)
-            for place in sorted_places:
-                st.markdown(f"### {place['name']}")
-                st.write(f"**Rating:** {place['rating']} stars  |  **Reviews:** {place['user_ratings_total']}")
-                google_maps_link = (
-                    f"https://www.google.com/maps/search/?api=1&query={place['name'].replace(' ', '+')}"
-                    f"&query_place_id={place['place_id']}"
-                )
-                st.markdown(f"[View on Google Maps]({google_maps_link})")
-                st.write("---")
-        else:
-            st.warning(f"No {selected_place_type.replace('_', ' ')}s found nearby.")
 
 # Render the map
 map_data = st_folium(m, width=700, height=500)
 
+if st.session_state.profile_runs:
+    st.subheader("Search Profile")
+    st.caption("Grid is spacing factor / query radius factor. Each search adds a run, so settings can be compared.")
+    st.dataframe(st.session_state.profile_runs[::-1], hide_index=True, use_container_width=True)
+    if st.button("Clear runs"):
+        st.session_state.profile_runs = []
+        st.session_state.profile = None
+        st.rerun()
+
+if profile is not None:
+    if profile['errors']:
+        st.error("Error fetching data from Google Places API.")
+    if profile['places']:
+        st.subheader(f"Top {selected_place_type.replace('_', ' ').title()}s Nearby:")
+        # Display sorted list of places
+        sorted_places = sorted(profile['places'], key=lambda x: x.get('user_ratings_total', 0), reverse=True)
+        for place in sorted_places:
+            name = place.get('name', 'Unknown Place')
+            st.markdown(f"### {name}")
+            st.write(f"**Rating:** {place.get('rating', 'N/A')} stars  |  **Reviews:** {place.get('user_ratings_total', 0)}")
+            google_maps_link = (
+                f"https://www.google.com/maps/search/?api=1&query={name.replace(' ', '+')}"
+                f"&query_place_id={place.get('place_id', '')}"
+            )
+            st.markdown(f"[View on Google Maps]({google_maps_link})")
+            st.write("---")
+    else:
+        st.warning(f"No {selected_place_type.replace('_', ' ')}s found nearby.")
+
 # Handle map clicks
 if map_data.get("last_clicked"):
     lat, lng = map_data["last_clicked"]["lat"], map_data["last_clicked"]["lng"]
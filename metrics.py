@@ -0,0 +1,152 @@
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import tracing
+from gazetteer import local_gazetteer
+from http_client import latency_stats
+from places_api import coalesce_stats
+from places_cache import places_cache
+from rate_limit import places_limiter
+from refresher import nearby_refresher
+from warm_start import startup_stats
+
+# Port of the Prometheus-style /metrics endpoint (0 leaves it off)
+METRICS_PORT = int(os.getenv('PLACES_METRICS_PORT', '0'))
+
+
+def _sample(name, value, **labels):
+    if labels:
+        label_text = ','.join(f'{key}="{value}"' for key, value in sorted(labels.items()))
+        return f"{name}{{{label_text}}} {value}"
+    return f"{name} {value}"
+
+
+def render_metrics():
+    # Process-wide aggregates in the Prometheus text exposition format
+    lines = []
+
+    def metric(name, kind, description, samples):
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} {kind}")
+        lines.extend(samples)
+
+    span_totals, attribute_totals, cache_hits = tracing.span_totals()
+    metric('places_spans_total', 'counter', "Finished search spans.", [
+        _sample('places_spans_total', count, span=name, status=status)
+        for (name, status), (count, _) in sorted(span_totals.items())
+    ])
+    metric('places_span_seconds_total', 'counter', "Time spent in search spans.", [
+        _sample('places_span_seconds_total', f"{seconds:.6f}", span=name, status=status)
+        for (name, status), (_, seconds) in sorted(span_totals.items())
+    ])
+    for attribute, description in (('bytes', "Response bytes"), ('result_count', "Places returned"),
+                                    ('retries', "HTTP retries")):
+        name = f"places_span_{attribute}_total"
+        metric(name, 'counter', f"{description} summed over search spans.", [
+            _sample(name, value, span=span_name)
+            for (span_name, key), value in sorted(attribute_totals.items()) if key == attribute
+        ])
+    metric('places_cache_lookups_total', 'counter', "Pages served from the cache or fetched live.", [
+        _sample('places_cache_lookups_total', count, span=name, hit=str(hit).lower())
+        for (name, hit), count in sorted(cache_hits.items())
+    ])
+
+    http = latency_stats()
+    for field, description in (('calls', "Upstream requests"), ('errors', "Failed upstream requests"),
+                               ('retries', "Upstream retries"), ('bytes', "Upstream response bytes")):
+        name = f"places_http_{field}_total"
+        metric(name, 'counter', f"{description} per endpoint.", [
+            _sample(name, stats[field], endpoint=endpoint) for endpoint, stats in sorted(http.items())
+        ])
+    metric('places_http_parse_seconds_total', 'counter',
+           "Time spent decoding and normalizing upstream responses per endpoint.", [
+               _sample('places_http_parse_seconds_total', f"{stats['parse_seconds']:.6f}", endpoint=endpoint)
+               for endpoint, stats in sorted(http.items())
+           ])
+    metric('places_http_latency_seconds', 'summary', "Upstream request latency per endpoint.", [
+        _sample('places_http_latency_seconds', f"{stats[field]:.6f}", endpoint=endpoint, quantile=quantile)
+        for endpoint, stats in sorted(http.items())
+        for quantile, field in (('0.5', 'p50_seconds'), ('0.95', 'p95_seconds'), ('1', 'max_seconds'))
+    ])
+
+    coalesce = coalesce_stats()
+    metric('places_coalesced_requests_total', 'counter', "Requests that shared another session's call.", [
+        _sample('places_coalesced_requests_total', stats['coalesced'], endpoint=endpoint)
+        for endpoint, stats in sorted(coalesce.items())
+    ])
+
+    if places_limiter is not None:
+        limiter = places_limiter.stats()
+        metric('places_rate_limit_acquired_total', 'counter', "Upstream requests let through the limiter.", [
+            _sample('places_rate_limit_acquired_total', limiter['acquired'])
+        ])
+        metric('places_rate_limit_throttled_total', 'counter', "Upstream requests that had to wait.", [
+            _sample('places_rate_limit_throttled_total', limiter['throttled'])
+        ])
+        metric('places_rate_limit_wait_seconds_total', 'counter', "Time requests spent waiting for the limiter.", [
+            _sample('places_rate_limit_wait_seconds_total', f"{limiter['wait_seconds']:.6f}")
+        ])
+
+    refresher = nearby_refresher.stats()
+    for field, description in (('refreshes', "Queries refreshed in the background"),
+                               ('refresh_calls', "Upstream calls made by the refresher"),
+                               ('failures', "Background refreshes that failed"),
+                               ('served', "Cached pages served to searches")):
+        metric(f"places_refresher_{field}_total", 'counter', f"{description}.", [
+            _sample(f"places_refresher_{field}_total", refresher[field])
+        ])
+    metric('places_served_age_seconds', 'summary', "Age of the cached pages served to searches.", [
+        _sample('places_served_age_seconds', f"{refresher[field]:.1f}", quantile=quantile)
+        for quantile, field in (('0.95', 'p95_age_seconds'), ('1', 'max_age_seconds'))
+    ])
+
+    metric('places_startup_seconds', 'gauge',
+           "Cold start phases: seconds from process start, or spent in the phase.", [
+               _sample('places_startup_seconds', f"{seconds:.3f}", phase=phase)
+               for phase, seconds in sorted(startup_stats().items())
+           ])
+
+    if local_gazetteer is not None:
+        gazetteer = local_gazetteer.stats()
+        metric('places_gazetteer_lookups_total', 'counter', "City queries answered by the local gazetteer.", [
+            _sample('places_gazetteer_lookups_total', gazetteer['hits'], result='hit'),
+            _sample('places_gazetteer_lookups_total', gazetteer['misses'], result='miss'),
+        ])
+        metric('places_gazetteer_learned', 'gauge', "API answers added to the gazetteer.", [
+            _sample('places_gazetteer_learned', gazetteer['learned'])
+        ])
+
+    if places_cache is not None:
+        cache = places_cache.stats()
+        for field in ('hits', 'misses', 'evictions'):
+            metric(f"places_cache_{field}_total", 'counter', f"Response cache {field}.", [
+                _sample(f"places_cache_{field}_total", cache[field])
+            ])
+        metric('places_cache_entries', 'gauge', "Entries in the response cache.", [
+            _sample('places_cache_entries', cache['entries'])
+        ])
+    return '\n'.join(lines) + '\n'
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render_metrics().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port=METRICS_PORT):
+    # Serve /metrics from a daemon thread; returns the server
+    server = ThreadingHTTPServer(('0.0.0.0', port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    return server
@@ -0,0 +1,105 @@
+import os
+
+from dotenv import load_dotenv
+
+from gazetteer import local_gazetteer
+from http_client import get_json
+from places_backends import nearby_backend
+from places_cache import details_key, nearby_key, places_cache
+from single_flight import SingleFlight
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Get API key from environment variables
+API_KEY = os.getenv('GOOGLE_MAPS_API_KEY')
+
+FIND_PLACE_URL = "https://maps.googleapis.com/maps/api/place/findplacefromtext/json"
+
+
+class PlacesApiError(Exception):
+    # Raised when a Places API search request fails or is refused
+    pass
+
+
+# Search statuses whose payload is a real answer and can be cached
+CACHEABLE_STATUSES = ('OK', 'ZERO_RESULTS')
+
+# Identical requests from concurrent sessions share one upstream call.
+# Keys are the cache keys, so requests that would share a cache entry
+# also share an in-flight call.
+details_flight = SingleFlight()
+nearby_flight = SingleFlight()
+
+
+# Function to fetch place details: from the local gazetteer when it knows
+# the name, else from the Google Places API (and then remembered locally)
+def fetch_place_details(query):
+    if local_gazetteer is not None:
+        place = local_gazetteer.resolve(query)
+        if place is not None:
+            return place
+    place = details_flight.do(details_key(query), _fetch_place_details, query)
+    if place is not None and local_gazetteer is not None:
+        local_gazetteer.learn(query, place)
+    return place
+
+
+def _fetch_place_details(query):
+    if places_cache is not None:
+        cached = places_cache.get(details_key(query))
+        if cached is not None:
+            return cached
+
+    status_code, payload = get_json(FIND_PLACE_URL, params={
+        'input': query,
+        'inputtype': 'textquery',
+        'fields': 'geometry,name',
+        'key': API_KEY,
+    })
+    if status_code == 200:
+        candidates = payload.get('candidates', [])
+        if candidates:
+            if places_cache is not None:
+                places_cache.set(details_key(query), candidates[0])
+            return candidates[0]  # Return the first matching place
+    return None
+
+
+def nearby_cache_key(location, radius, place_type, page_index=0):
+    # Cache key of a nearby page from the configured backend
+    return nearby_key(location, radius, place_type, page_index, nearby_backend.cache_namespace)
+
+
+def cached_nearby_entry(location, radius, place_type, page_index=0):
+    # Look a page up in the cache without touching the network; returns
+    # (cached page, age in seconds) or None
+    if places_cache is None:
+        return None
+    return places_cache.get_entry(nearby_cache_key(location, radius, place_type, page_index))
+
+
+def fetch_nearby_page(location, radius, place_type, page_index=0, page_token=None):
+    # Fetch one live page from the configured backend (places_backends) as
+    # normalized place records. A later page answered with INVALID_REQUEST
+    # usually means its token is not valid yet; the caller decides whether
+    # to retry.
+    key = nearby_cache_key(location, radius, place_type, page_index)
+    return nearby_flight.do(key, _fetch_nearby_page, location, radius, place_type, page_index, page_token)
+
+
+def _fetch_nearby_page(location, radius, place_type, page_index, page_token):
+    status_code, page = nearby_backend.search(API_KEY, location, radius, place_type, page_token)
+    if status_code != 200:
+        raise PlacesApiError(f"Nearby search ({nearby_backend.name} backend) failed with HTTP {status_code}")
+    if places_cache is not None and page['status'] in CACHEABLE_STATUSES:
+        places_cache.set(nearby_cache_key(location, radius, place_type, page_index), page)
+    return page
+
+
+def coalesce_stats():
+    # How many upstream calls were made and how many duplicates piggybacked
+    return {
+        'findplacefromtext': details_flight.stats(),
+        nearby_backend.endpoint: nearby_flight.stats(),
+    }
@@ -0,0 +1,115 @@
+import os
+
+from http_client import get_json, post_json
+
+# Interchangeable Places nearby-search backends. Both return pages of the
+# same normalized place records, so search, ranking and the map never see
+# which API answered:
+#   legacy - place/nearbysearch/json: full place objects, 3 pages of 20
+#   new    - Places API (New) places:searchNearby with a field mask: only
+#            the fields below, one page of up to 20
+
+# Which backend nearby searches go to
+PLACES_BACKEND = os.getenv('PLACES_BACKEND', 'legacy')
+
+LEGACY_NEARBY_URL = "https://maps.googleapis.com/maps/api/place/nearbysearch/json"
+SEARCH_NEARBY_URL = "https://places.googleapis.com/v1/places:searchNearby"
+# Everything the ranking, map and lists read, and nothing else (photos,
+# opening hours and the like are also billed at higher SKUs)
+SEARCH_NEARBY_FIELD_MASK = ','.join([
+    'places.id', 'places.displayName', 'places.location', 'places.rating',
+    'places.userRatingCount', 'places.types',
+])
+# searchNearby answers at most 20 places and has no further pages
+SEARCH_NEARBY_MAX_RESULTS = 20
+
+
+def place_record(place_id, name, lat, lng, rating, user_ratings_total, types):
+    # The normalized place record both backends return (shaped like the
+    # legacy result the app was written against; unrated places have no
+    # 'rating', like legacy results)
+    record = {
+        'place_id': place_id,
+        'name': name,
+        'geometry': {'location': {'lat': lat, 'lng': lng}},
+        'user_ratings_total': user_ratings_total or 0,
+        'types': types or [],
+    }
+    if rating is not None:
+        record['rating'] = rating
+    return record
+
+
+class LegacyNearbyBackend:
+    name = 'legacy'
+    endpoint = 'nearbysearch'
+    max_pages = 3
+    # Keeps the cache entries written before backends existed
+    cache_namespace = 'nearby'
+
+    def search(self, api_key, location, radius, place_type, page_token=None):
+        # (HTTP status, page or None)
+        params = {'location': location, 'radius': radius, 'type': place_type, 'key': api_key}
+        if page_token:
+            params['pagetoken'] = page_token
+        return get_json(LEGACY_NEARBY_URL, params=params, parse=self.parse)
+
+    def parse(self, payload):
+        results = []
+        for place in payload.get('results', []):
+            location = place.get('geometry', {}).get('location')
+            if not location or not place.get('place_id'):
+                continue
+            results.append(place_record(
+                place['place_id'], place.get('name'), location['lat'], location['lng'],
+                place.get('rating'), place.get('user_ratings_total'), place.get('types'),
+            ))
+        return {
+            'status': payload.get('status'),
+            'results': results,
+            'next_page_token': payload.get('next_page_token'),
+        }
+
+
+class SearchNearbyBackend:
+    name = 'new'
+    endpoint = 'places:searchNearby'
+    max_pages = 1
+    cache_namespace = 'nearby-new'
+
+    def search(self, api_key, location, radius, place_type, page_token=None):
+        # (HTTP status, page or None); page_token is never issued here
+        lat, lng = (float(value) for value in str(location).split(','))
+        body = {
+            'maxResultCount': SEARCH_NEARBY_MAX_RESULTS,
+            'rankPreference': 'POPULARITY',
+            'locationRestriction': {'circle': {
+                'center': {'latitude': lat, 'longitude': lng},
+                'radius': float(radius),
+            }},
+        }
+        if place_type:
+            body['includedTypes'] = [place_type]
+        headers = {'X-Goog-Api-Key': api_key, 'X-Goog-FieldMask': SEARCH_NEARBY_FIELD_MASK}
+        return post_json(SEARCH_NEARBY_URL, body, headers=headers, parse=self.parse)
+
+    def parse(self, payload):
+        # An empty answer is {} rather than a ZERO_RESULTS status
+        results = []
+        for place in payload.get('places', []):
+            location = place.get('location')
+            if not location or not place.get('id'):
+                continue
+            results.append(place_record(
+                place['id'], place.get('displayName', {}).get('text'),
+                location['latitude'], location['longitude'],
+                place.get('rating'), place.get('userRatingCount'), place.get('types'),
+            ))
+        return {'status': 'OK' if results else 'ZERO_RESULTS', 'results': results, 'next_page_token': None}
+
+
+NEARBY_BACKENDS = {backend.name: backend for backend in (LegacyNearbyBackend(), SearchNearbyBackend())}
+if PLACES_BACKEND not in NEARBY_BACKENDS:
+    raise ValueError(f"PLACES_BACKEND must be one of {', '.join(NEARBY_BACKENDS)}, not {PLACES_BACKEND!r}")
+# The backend every nearby search of the process uses
+nearby_backend = NEARBY_BACKENDS[PLACES_BACKEND]
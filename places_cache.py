@@ -0,0 +1,141 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# Where the cache lives. Point this at a mounted volume so it survives
+# container restarts; set it to an empty string to disable caching.
+CACHE_PATH = os.getenv('PLACES_CACHE_PATH', 'places_cache.sqlite')
+# How long a cached response stays valid, in seconds (default: 1 day)
+CACHE_TTL = int(os.getenv('PLACES_CACHE_TTL', str(24 * 60 * 60)))
+# Maximum number of cached responses before least recently used ones are evicted
+CACHE_MAX_ENTRIES = int(os.getenv('PLACES_CACHE_MAX_ENTRIES', '5000'))
+# Decimal places kept from lat/lng in cache keys (4 decimals is roughly 11 m)
+CACHE_PRECISION = int(os.getenv('PLACES_CACHE_PRECISION', '4'))
+
+
+def nearby_key(location, radius, place_type, page_index, namespace='nearby'):
+    # Quantize the coordinates so marker positions a few metres apart share
+    # entries; each Places backend caches under its own namespace
+    lat, lng = (float(value) for value in str(location).split(','))
+    return (
+        f"{namespace}:{round(lat, CACHE_PRECISION):.{CACHE_PRECISION}f},"
+        f"{round(lng, CACHE_PRECISION):.{CACHE_PRECISION}f}:"
+        f"{int(radius)}:{place_type}:{page_index}"
+    )
+
+
+def details_key(query):
+    return f"details:{' '.join(str(query).lower().split())}"
+
+
+class PlacesCache:
+    # SQLite-backed key/value store for parsed Places API responses, with a
+    # TTL per entry, LRU eviction above max_entries and hit/miss counters.
+    # A single connection is shared by all threads behind a lock.
+
+    def __init__(self, path, ttl=CACHE_TTL, max_entries=CACHE_MAX_ENTRIES):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " key TEXT PRIMARY KEY,"
+            " value TEXT NOT NULL,"
+            " created_at REAL NOT NULL,"
+            " last_used REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)"
+        )
+
+    def get(self, key):
+        entry = self.get_entry(key)
+        return entry[0] if entry is not None else None
+
+    def get_entry(self, key):
+        # (value, age in seconds) for a live entry, else None
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, created_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            value, created_at = row
+            if now - created_at > self.ttl:
+                self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self.misses += 1
+                return None
+            self._conn.execute(
+                "UPDATE responses SET last_used = ? WHERE key = ?", (now, key)
+            )
+            self.hits += 1
+        return json.loads(value), now - created_at
+
+    def age(self, key):
+        # Seconds since the entry was stored (None if missing or expired),
+        # without counting as a lookup or refreshing its LRU position
+        with self._lock:
+            row = self._conn.execute("SELECT created_at FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None or time.time() - row[0] > self.ttl:
+            return None
+        return time.time() - row[0]
+
+    def set(self, key, value):
+        now = time.time()
+        payload = json.dumps(value, separators=(',', ':'))
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, value, created_at, last_used)"
+                " VALUES (?, ?, ?, ?)",
+                (key, payload, now, now),
+            )
+            self._evict()
+
+    def _evict(self):
+        # Drop expired rows first, then the least recently used ones over the cap
+        self._conn.execute(
+            "DELETE FROM responses WHERE created_at < ?", (time.time() - self.ttl,)
+        )
+        (count,) = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()
+        excess = count - self.max_entries
+        if excess > 0:
+            self._conn.execute(
+                "DELETE FROM responses WHERE key IN ("
+                " SELECT key FROM responses ORDER BY last_used LIMIT ?)",
+                (excess,),
+            )
+            self.evictions += excess
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM responses")
+
+    def stats(self):
+        with self._lock:
+            (entries,) = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'evictions': self.evictions,
+            'entries': entries,
+        }
+
+
+# Process-wide cache shared by every Streamlit session
+places_cache = PlacesCache(CACHE_PATH) if CACHE_PATH else None
@@ -0,0 +1,70 @@
+import os
+import threading
+import time
+
+# Upstream requests per second allowed across every session of the process
+RATE_LIMIT = float(os.getenv('PLACES_RATE_LIMIT', '10'))
+# Requests that may go out back to back before the rate applies
+RATE_BURST = int(os.getenv('PLACES_RATE_BURST', '20'))
+
+
+class TokenBucket:
+    # Thread-safe token bucket: `rate` tokens are added per second, up to
+    # `burst`; acquire() blocks until a token is available
+
+    def __init__(self, rate=RATE_LIMIT, burst=RATE_BURST):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+        self.acquired = 0
+        self.throttled = 0
+        self.wait_seconds = 0.0
+
+    def _refill(self, now):
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self):
+        # Take one token, sleeping outside the lock while the bucket refills;
+        # returns the seconds waited
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    self.acquired += 1
+                    self.throttled += waited > 0
+                    self.wait_seconds += waited
+                    return waited
+                delay = (1 - self._tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+    def try_acquire(self):
+        # Take a token if one is available right now; never blocks
+        with self._lock:
+            self._refill(time.monotonic())
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            self.acquired += 1
+            return True
+
+    def stats(self):
+        with self._lock:
+            return {
+                'rate': self.rate,
+                'burst': self.burst,
+                'acquired': self.acquired,
+                'throttled': self.throttled,
+                'wait_seconds': self.wait_seconds,
+            }
+
+
+# Shared by every Google Maps request of the process (None when
+# PLACES_RATE_LIMIT is 0)
+places_limiter = TokenBucket() if RATE_LIMIT > 0 else None
@@ -0,0 +1,175 @@
+import os
+import threading
+import time
+from collections import deque
+
+import tracing
+from places_api import CACHEABLE_STATUSES, PlacesApiError, fetch_nearby_page, nearby_cache_key
+from places_backends import nearby_backend
+from places_cache import CACHE_TTL, places_cache
+from rate_limit import TokenBucket
+
+# Stale-while-revalidate for nearby searches: searches are always served
+# the cached pages, and a background thread re-fetches the most requested
+# (location, radius, type) queries before their cache entries expire.
+
+# Upstream calls the refresher may spend per hour (0 disables it)
+REFRESH_BUDGET = int(os.getenv('PLACES_REFRESH_BUDGET', '120'))
+# Entries older than this many seconds are due for a refresh
+REFRESH_AFTER = float(os.getenv('PLACES_REFRESH_AFTER', str(CACHE_TTL * 0.75)))
+# Seconds between two passes over the hottest queries
+REFRESH_INTERVAL = float(os.getenv('PLACES_REFRESH_INTERVAL', '60'))
+# Queries considered per pass, and the demand they need to be refreshed
+REFRESH_TOP = 50
+REFRESH_MIN_SCORE = 2.0
+# Demand scores halve after this many seconds without requests
+HOTNESS_HALF_LIFE = 6 * 60 * 60
+# Queries tracked at most; the coldest half is dropped beyond this
+MAX_TRACKED = 2000
+# Wait before using a fresh next_page_token, and retries while it is not valid yet
+REFRESH_TOKEN_DELAY = 2.0
+REFRESH_TOKEN_RETRIES = 4
+# Ages of served cache entries kept for the staleness stats
+STALENESS_SAMPLES = 1000
+
+
+class NearbyRefresher:
+    # Tracks demand per nearby query and keeps the hottest ones fresh from a
+    # daemon thread, within a calls-per-hour budget
+
+    def __init__(self, budget=REFRESH_BUDGET, refresh_after=REFRESH_AFTER, interval=REFRESH_INTERVAL):
+        self.refresh_after = refresh_after
+        self.interval = interval
+        self.budget = TokenBucket(rate=budget / 3600, burst=max(1, budget // 4)) if budget > 0 else None
+        self._lock = threading.Lock()
+        self._scores = {}  # query -> (score, last touched)
+        self._ages = deque(maxlen=STALENESS_SAMPLES)
+        self._stop = threading.Event()
+        self._thread = None
+        self.served = 0
+        self.refreshes = 0
+        self.refresh_calls = 0
+        self.failures = 0
+
+    def touch(self, query):
+        # Count one request for a (location, radius, place type) query
+        now = time.time()
+        with self._lock:
+            score, touched = self._scores.get(query, (0.0, now))
+            self._scores[query] = (score * 0.5 ** ((now - touched) / HOTNESS_HALF_LIFE) + 1, now)
+            if len(self._scores) > MAX_TRACKED:
+                coldest = sorted(self._scores, key=lambda key: self._scores[key][0])
+                for key in coldest[:len(coldest) // 2]:
+                    del self._scores[key]
+
+    def served_from_cache(self, age):
+        # Record the age of a cached page handed to a search
+        with self._lock:
+            self.served += 1
+            self._ages.append(age)
+
+    def hottest(self, count=REFRESH_TOP):
+        now = time.time()
+        with self._lock:
+            scores = [
+                (score * 0.5 ** ((now - touched) / HOTNESS_HALF_LIFE), query)
+                for query, (score, touched) in self._scores.items()
+            ]
+        scores.sort(reverse=True)
+        return [(query, score) for score, query in scores[:count]]
+
+    def snapshot(self):
+        # Demand scores, for the warm-start snapshot
+        with self._lock:
+            return dict(self._scores)
+
+    def restore(self, scores):
+        with self._lock:
+            for query, (score, touched) in scores.items():
+                self._scores.setdefault(query, (score, touched))
+
+    def start(self):
+        # Start the refresh thread (once); a no-op without cache or budget
+        if places_cache is None or self.budget is None or self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name='nearby-refresher', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.refresh_due()
+
+    def refresh_due(self):
+        # One pass: refresh the hot queries whose first page is getting old
+        for query, score in self.hottest():
+            if score < REFRESH_MIN_SCORE or self._stop.is_set():
+                break
+            age = places_cache.age(nearby_cache_key(*query, 0))
+            if age is None or age < self.refresh_after:
+                # Missing entries are fetched by the next search that needs them
+                continue
+            if not self.budget.try_acquire():
+                break
+            self.refresh(query)
+
+    def refresh(self, query):
+        # Re-fetch as many pages of the query as are cached now. The first
+        # page's budget token is already taken.
+        location, radius, place_type = query
+        pages = 1
+        while (pages < nearby_backend.max_pages
+               and places_cache.age(nearby_cache_key(location, radius, place_type, pages)) is not None):
+            pages += 1
+        with tracing.span('refresh', location=location, radius=radius, place_type=place_type, pages=pages):
+            try:
+                token = None
+                for page_index in range(pages):
+                    if page_index and not self.budget.try_acquire():
+                        break
+                    page = self._fetch(location, radius, place_type, page_index, token)
+                    token = page.get('next_page_token')
+                    if page['status'] not in CACHEABLE_STATUSES or not token:
+                        break
+            except (PlacesApiError, OSError):
+                with self._lock:
+                    self.failures += 1
+                return
+        with self._lock:
+            self.refreshes += 1
+
+    def _fetch(self, location, radius, place_type, page_index, token):
+        # Live page fetch (which rewrites its cache entry), waiting out
+        # not-yet-valid page tokens
+        for attempt in range(REFRESH_TOKEN_RETRIES + 1):
+            if token:
+                time.sleep(REFRESH_TOKEN_DELAY)
+            if attempt and not self.budget.try_acquire():
+                break
+            with self._lock:
+                self.refresh_calls += 1
+            page = fetch_nearby_page(location, radius, place_type, page_index, token)
+            if not (token and page['status'] == 'INVALID_REQUEST'):
+                return page
+        return {'status': 'INVALID_REQUEST', 'results': []}
+
+    def stats(self):
+        with self._lock:
+            ages = sorted(self._ages)
+            return {
+                'tracked': len(self._scores),
+                'refreshes': self.refreshes,
+                'refresh_calls': self.refresh_calls,
+                'failures': self.failures,
+                'served': self.served,
+                'mean_age_seconds': sum(ages) / len(ages) if ages else 0.0,
+                'p95_age_seconds': ages[min(len(ages) - 1, int(len(ages) * 0.95))] if ages else 0.0,
+                'max_age_seconds': ages[-1] if ages else 0.0,
+            }
+
+
+# Process-wide refresher; searches report demand to it even when its
+# thread is not running
+nearby_refresher = NearbyRefresher()
@@ -0,0 +1,152 @@
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from ranking import bayesian_rating, density_reviews, top_k_indices
+
+# Column layout of a search result. Categories and types repeat a lot, so
+# they are dictionary encoded. category is the primary category, categories
+# every category the place was found under; the last two columns are
+# ranking scores (see ranking.py).
+PLACE_SCHEMA = pa.schema([
+    ('place_id', pa.string()),
+    ('name', pa.string()),
+    ('lat', pa.float64()),
+    ('lng', pa.float64()),
+    ('rating', pa.float64()),
+    ('user_ratings_total', pa.int32()),
+    ('category', pa.dictionary(pa.int16(), pa.string())),
+    ('types', pa.list_(pa.dictionary(pa.int16(), pa.string()))),
+    ('categories', pa.list_(pa.dictionary(pa.int16(), pa.string()))),
+    ('bayes_rating', pa.float64()),
+    ('density_reviews', pa.float64()),
+])
+
+
+def _dictionary_list(lists):
+    # Build a list<dictionary<string>> column from Python lists of strings
+    offsets = [0]
+    values = []
+    for items in lists:
+        values.extend(items)
+        offsets.append(len(values))
+    encoded = pa.array(values, pa.string()).dictionary_encode()
+    encoded = encoded.cast(pa.dictionary(pa.int16(), pa.string()))
+    return pa.ListArray.from_arrays(pa.array(offsets, pa.int32()), encoded)
+
+
+class PlaceTable:
+    # Compact, immutable store for the places a search found, one Arrow
+    # column per field. Sorting, filtering and top-k run on whole columns;
+    # every operation returns a new PlaceTable.
+
+    def __init__(self, table, sort_key=None):
+        self.table = table
+        # Column the rows are currently sorted on (descending), if any
+        self.sort_key = sort_key
+
+    @classmethod
+    def from_places(cls, places):
+        # places are compact records as returned by search.dedupe_places
+        locations = [place.get('geometry', {}).get('location', {}) for place in places]
+        lats = pa.array([location.get('lat') for location in locations], pa.float64())
+        lngs = pa.array([location.get('lng') for location in locations], pa.float64())
+        ratings = pa.array([place.get('rating') for place in places], pa.float64())
+        reviews = pa.array([place.get('user_ratings_total', 0) for place in places], pa.int32())
+        # Missing values become NaN for the NumPy scores
+        lat_values = lats.to_numpy(zero_copy_only=False)
+        lng_values = lngs.to_numpy(zero_copy_only=False)
+        review_values = reviews.fill_null(0).to_numpy()
+        columns = [
+            pa.array([place.get('place_id') for place in places], pa.string()),
+            pa.array([place.get('name') for place in places], pa.string()),
+            lats,
+            lngs,
+            ratings,
+            reviews,
+            pa.array([place.get('category') for place in places], pa.string())
+              .dictionary_encode().cast(PLACE_SCHEMA.field('category').type),
+            _dictionary_list([place.get('types', []) for place in places]),
+            _dictionary_list([
+                place.get('categories') or ([place['category']] if place.get('category') else [])
+                for place in places
+            ]),
+            pa.array(bayesian_rating(ratings.to_numpy(zero_copy_only=False), review_values), pa.float64()),
+            pa.array(density_reviews(review_values, lat_values, lng_values), pa.float64()),
+        ]
+        return cls(pa.Table.from_arrays(columns, schema=PLACE_SCHEMA))
+
+    @classmethod
+    def empty(cls):
+        return cls(PLACE_SCHEMA.empty_table())
+
+    def __len__(self):
+        return self.table.num_rows
+
+    @property
+    def nbytes(self):
+        # Memory held by this result set's buffers
+        return self.table.nbytes
+
+    def column(self, name):
+        return self.table.column(name)
+
+    def sort_by(self, column='user_ratings_total'):
+        # Sort descending on one column; a no-op when already sorted on it
+        if self.sort_key == column:
+            return self
+        indices = pc.sort_indices(self.table, sort_keys=[(column, 'descending')])
+        return PlaceTable(self.table.take(indices), sort_key=column)
+
+    def top_k(self, k, column='user_ratings_total'):
+        # The k largest rows on a column, in descending order, without a full sort
+        if self.sort_key == column:
+            return PlaceTable(self.table.slice(0, k), sort_key=column)
+        # Same order as sort_by (a stable sort, ties in table order), so pages
+        # of growing k line up with each other and with the export
+        scores = self.table[column].to_numpy()
+        return PlaceTable(self.table.take(top_k_indices(scores, k)), sort_key=column)
+
+    def _list_contains(self, column, value):
+        # Mask of rows whose list column contains value
+        values = self.table[column].combine_chunks().cast(pa.list_(pa.string()))
+        matches = pc.list_parent_indices(values).filter(pc.equal(pc.list_flatten(values), value))
+        return pc.is_in(pa.array(np.arange(len(self))), value_set=matches)
+
+    def filter(self, category=None, min_rating=None, min_reviews=None, place_type=None):
+        # category matches any category a place was found under
+        mask = pa.array(np.ones(len(self), dtype=bool))
+        if category is not None:
+            mask = pc.and_(mask, self._list_contains('categories', category))
+        if min_rating is not None:
+            mask = pc.and_kleene(mask, pc.greater_equal(self.table['rating'], min_rating))
+        if min_reviews is not None:
+            mask = pc.and_(mask, pc.greater_equal(self.table['user_ratings_total'], min_reviews))
+        if place_type is not None:
+            mask = pc.and_(mask, self._list_contains('types', place_type))
+        return PlaceTable(self.table.filter(pc.fill_null(mask, False)), sort_key=self.sort_key)
+
+    def filter_located(self):
+        # Only the places that have coordinates
+        return PlaceTable(self.table.filter(self.table['lat'].is_valid()), sort_key=self.sort_key)
+
+    def exclude(self, place_ids):
+        # Every place except the given place_ids
+        mask = pc.invert(pc.is_in(self.table['place_id'], value_set=pa.array(place_ids, pa.string())))
+        return PlaceTable(self.table.filter(pc.fill_null(mask, True)), sort_key=self.sort_key)
+
+    def to_places(self):
+        # Back to compact place dicts, for code that works row by row
+        return [
+            {
+                'place_id': row['place_id'],
+                'name': row['name'],
+                'rating': row['rating'],
+                'user_ratings_total': row['user_ratings_total'],
+                'category': row['category'],
+                'categories': row['categories'],
+                'types': row['types'],
+                'geometry': {'location': {'lat': row['lat'], 'lng': row['lng']}},
+            }
+            for row in self.table.to_pylist()
+        ]
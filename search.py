@@ -0,0 +1,578 @@
+import heapq
+import math
+import os
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import tracing
+from places_api import (
+    CACHEABLE_STATUSES, PlacesApiError, cached_nearby_entry, fetch_nearby_page,
+)
+from places_backends import nearby_backend
+from refresher import nearby_refresher
+
+# Maximum number of page requests in flight at the same time
+MAX_CONCURRENT_REQUESTS = int(os.getenv('PLACES_MAX_CONCURRENCY', '8'))
+# Every search gives up on pages it could not fetch within this many seconds
+SEARCH_DEADLINE = float(os.getenv('PLACES_SEARCH_DEADLINE', '30'))
+# A fresh next_page_token is first tried after this delay, then retried with
+# exponential backoff while Google still answers INVALID_REQUEST
+PAGE_TOKEN_DELAY = float(os.getenv('PLACES_PAGE_TOKEN_DELAY', '1.0'))
+PAGE_TOKEN_BACKOFF = 0.25
+PAGE_TOKEN_MAX_BACKOFF = 2.0
+PAGE_TOKEN_MAX_RETRIES = 8
+# Pages the configured backend serves per query (3 for nearbysearch,
+# 1 for searchNearby)
+MAX_PAGES = nearby_backend.max_pages
+# Fields of a Places result the app keeps once a search is done
+PLACE_FIELDS = ('place_id', 'name', 'rating', 'user_ratings_total', 'types')
+
+# Nearby Search returns at most this many places per page
+PAGE_SIZE = 20
+# Approximate length of one degree of latitude, in meters
+METERS_PER_DEGREE = 111320
+# Adaptive search stops splitting below this radius, or once the budget is spent
+ADAPTIVE_MIN_RADIUS = 100
+ADAPTIVE_MAX_CALLS = 60
+# Upstream page requests one search may make by default
+SEARCH_CALL_BUDGET = int(os.getenv('PLACES_SEARCH_CALL_BUDGET', '60'))
+# Categories a typeless search covers
+MAIN_PLACE_TYPES = ['restaurant', 'bar', 'cafe', 'tourist_attraction', 'museum']
+
+
+# Function to calculate grid points for a 3x3 grid
+def calculate_grid_points(center, radius, spacing=0.5):
+    lat, lng = center
+    # Offsets between neighbouring points, as a fraction of the radius
+    lat_offset = (radius * 0.00001) * spacing
+    lng_offset = (radius * 0.00001 / math.cos(math.radians(lat))) * spacing  # Adjusted for longitude distortion
+
+    grid_points = []
+    for i in range(-1, 2):  # -1, 0, 1
+        for j in range(-1, 2):  # -1, 0, 1
+            grid_points.append([
+                lat + (i * lat_offset),
+                lng + (j * lng_offset)
+            ])
+    return grid_points
+
+
+def offset_point(center, north, east):
+    # Move a [lat, lng] point by the given distances in meters
+    lat, lng = center
+    return [
+        lat + north / METERS_PER_DEGREE,
+        lng + east / (METERS_PER_DEGREE * math.cos(math.radians(lat))),
+    ]
+
+
+def build_queries(points, radius, place_types):
+    # One (location string, radius, place type) query per point and category,
+    # ordered point by point so dedupe keeps the same winner as a serial loop
+    return [
+        (f"{point[0]},{point[1]}", radius, place_type)
+        for point in points
+        for place_type in place_types
+    ]
+
+
+class CallBudget:
+    # Cap on the upstream page requests of one search. fit() drops the
+    # outermost grid cells until every query can fetch its first page; the
+    # scheduler then only follows next_page_tokens while calls are left.
+
+    def __init__(self, limit=SEARCH_CALL_BUDGET):
+        self.limit = limit
+        self.spent = 0
+        self.cells_dropped = 0
+        self.queries_dropped = 0
+        self.pages_dropped = 0
+
+    def fit(self, queries, center):
+        # The queries to run, nearest cells first until the budget is full
+        if len(queries) <= self.limit:
+            return queries
+        cells = {}
+        for query in queries:
+            cells.setdefault(query[0], []).append(query)
+
+        def distance(location):
+            lat, lng = (float(value) for value in location.split(','))
+            return math.hypot(lat - center[0], (lng - center[1]) * math.cos(math.radians(center[0])))
+
+        kept_cells = set()
+        count = 0
+        for location in sorted(cells, key=distance):
+            if count + len(cells[location]) > self.limit:
+                break
+            kept_cells.add(location)
+            count += len(cells[location])
+        kept = [query for query in queries if query[0] in kept_cells]
+        if not kept:
+            # Not even the center cell fits: keep as many of its categories as possible
+            kept = cells[min(cells, key=distance)][:self.limit]
+        self.cells_dropped = len(cells) - len(kept_cells)
+        self.queries_dropped = len(queries) - len(kept)
+        return kept
+
+    def estimate(self, queries, fetch_all_pages=False):
+        # (fewest, most) upstream calls a search of these queries can make,
+        # token retries aside
+        kept = min(len(queries), self.limit)
+        pages = MAX_PAGES if fetch_all_pages else 1
+        return kept, min(len(queries) * pages, self.limit)
+
+
+def token_retry_delay(attempt):
+    return min(PAGE_TOKEN_BACKOFF * 2 ** (attempt - 1), PAGE_TOKEN_MAX_BACKOFF)
+
+
+def iter_search(queries, fetch_all_pages=False, max_workers=None, deadline=SEARCH_DEADLINE,
+                place_index=None, budget=None):
+    # Yields (index, results, error) as each query's page chain finishes
+    for index, results, error, done in iter_search_pages(
+            queries, fetch_all_pages, max_workers, deadline, place_index, budget):
+        if done:
+            yield index, results, error
+
+
+def iter_search_pages(queries, fetch_all_pages=False, max_workers=None, deadline=SEARCH_DEADLINE,
+                      place_index=None, budget=None):
+    # Page-level scheduler for a batch of (location, radius, place type)
+    # queries. Every page request is its own task on the thread pool; while
+    # a query waits for its next_page_token to become valid, the workers
+    # serve other queries instead of sleeping. Yields (index, results, error,
+    # done) in the caller's thread, so it is safe to update Streamlit widgets
+    # between items: done=False carries one newly arrived page, done=True
+    # all of a finished query's results. Pages not fetched within `deadline`
+    # seconds are dropped. With a spatial_index.PlaceIndex, queries it fully
+    # covers are answered locally and finished ones are recorded into it.
+    # With a CallBudget, later pages are only fetched while the budget still
+    # covers them and every first page not requested yet. Every cell, query
+    # and page gets a span under the current span, or under a new 'search'
+    # span when there is none.
+    if not queries:
+        return
+    parent = tracing.current_span()
+    root = tracing.start_span('search', queries=len(queries)) if parent is None else None
+    try:
+        yield from _schedule_pages(
+            queries, fetch_all_pages, max_workers, deadline, place_index, budget, root or parent)
+    finally:
+        if root is not None:
+            root.end()
+
+
+def _schedule_pages(queries, fetch_all_pages, max_workers, deadline, place_index, budget, parent_span):
+    max_pages = MAX_PAGES if fetch_all_pages else 1
+    stop_at = time.monotonic() + deadline
+    chains = [
+        {
+            'results': [],
+            'page_index': 0,   # next page to fetch
+            'collected': 0,    # pages whose results are already kept
+            'token': None,     # live token for page_index, if any
+            'not_before': 0,   # earliest time the next live request may go out
+            'attempt': 0,
+        }
+        for _ in queries
+    ]
+    ready = deque(range(len(queries)))
+    waiting = []  # heap of (due time, chain index)
+    running = {}  # future -> chain index
+    finished = set()
+    arrived = deque()  # (chain index, page results) not yet yielded
+    first_pending = set(range(len(queries)))  # chains whose first page is not requested yet
+
+    cell_spans = {}  # location -> [span, queries not finished yet]
+    for location, _, _ in queries:
+        if location not in cell_spans:
+            cell_spans[location] = [tracing.start_span('cell', parent_span, location=location), 0]
+        cell_spans[location][1] += 1
+    query_spans = [
+        tracing.start_span('query', cell_spans[location][0], place_type=place_type, radius=radius)
+        for location, radius, place_type in queries
+    ]
+    page_spans = {}  # future -> span
+
+    def end_query_span(index, **attributes):
+        query_spans[index].end(**attributes)
+        cell = cell_spans[queries[index][0]]
+        cell[1] -= 1
+        if not cell[1]:
+            cell[0].end()
+
+    if place_index is not None:
+        for index, query in enumerate(queries):
+            if place_index.covers(query):
+                finished.add(index)
+                ready.remove(index)
+                first_pending.discard(index)
+                # No more places than the API would have returned, so the
+                # answer looks the same (and is as saturated) either way
+                results = place_index.lookup(query, PAGE_SIZE * max_pages)
+                end_query_span(index, local=True, result_count=len(results))
+                if results:
+                    yield index, results, None, False
+                yield index, results, None, True
+
+    # Demand for the queries that go to the cache or the API decides what
+    # the background refresher keeps fresh
+    for index in ready:
+        nearby_refresher.touch(queries[index])
+
+    def accept(index, page, live):
+        # Keep a page's results and move the chain on; True when it is done
+        chain = chains[index]
+        first_pending.discard(index)
+        if chain['page_index'] >= chain['collected']:
+            chain['results'].extend(page['results'])
+            chain['collected'] = chain['page_index'] + 1
+            if page['results']:
+                arrived.append((index, page['results']))
+        # Tokens stored in the cache have long expired
+        chain['token'] = page.get('next_page_token') if live else None
+        chain['not_before'] = time.monotonic() + PAGE_TOKEN_DELAY if live else 0
+        chain['attempt'] = 0
+        if not page.get('next_page_token') or chain['page_index'] + 1 >= max_pages:
+            return True
+        chain['page_index'] += 1
+        ready.append(index)
+        return False
+
+    def step(index):
+        # Serve the chain's next page from the cache or schedule a live fetch;
+        # True when the chain finished without needing the network
+        chain = chains[index]
+        location, radius, place_type = queries[index]
+        page_index = chain['page_index']
+        if page_index >= chain['collected']:
+            entry = cached_nearby_entry(location, radius, place_type, page_index)
+            if entry is not None:
+                cached, age = entry
+                nearby_refresher.served_from_cache(age)
+                tracing.start_span('page', query_spans[index], page_index=page_index, cache_hit=True).end(
+                    status=cached['status'], result_count=len(cached['results']), cache_age=round(age))
+                return accept(index, cached, live=False)
+        if page_index and chain['token'] is None:
+            # The previous page came from the cache; replay the chain live
+            # from the first page to get a usable token
+            chain['page_index'] = 0
+            chain['not_before'] = 0
+            page_index = 0
+        if budget is not None and chain['collected'] and budget.spent + len(first_pending) >= budget.limit:
+            # Out of calls: keep the pages already collected, but not as a
+            # complete answer for the area
+            budget.pages_dropped += 1
+            chain['truncated'] = True
+            query_spans[index].set(budget_exhausted=True)
+            return True
+        if chain['not_before'] > time.monotonic():
+            heapq.heappush(waiting, (chain['not_before'], index))
+        else:
+            if budget is not None:
+                budget.spent += 1
+            first_pending.discard(index)
+            page_span = tracing.start_span(
+                'page', query_spans[index], page_index=page_index, cache_hit=False,
+                attempt=chain['attempt'],
+            )
+            future = executor.submit(
+                tracing.run_in_span, page_span, fetch_nearby_page, location, radius, place_type,
+                page_index, chain['token']
+            )
+            running[future] = index
+            page_spans[future] = page_span
+        return False
+
+    def handle(index, future):
+        # Process a finished live page request; True when the chain is done
+        chain = chains[index]
+        page_span = page_spans.pop(future)
+        try:
+            page = future.result()
+        except (PlacesApiError, OSError) as error:
+            page_span.end(status='ERROR', error=repr(error))
+            chain['error'] = error
+            return True
+        page_span.end(status=page['status'], result_count=len(page['results']))
+        if page['status'] == 'INVALID_REQUEST' and chain['page_index']:
+            chain['attempt'] += 1
+            if chain['attempt'] > PAGE_TOKEN_MAX_RETRIES:
+                chain['truncated'] = True
+                return True
+            chain['not_before'] = time.monotonic() + token_retry_delay(chain['attempt'])
+            ready.append(index)
+            return False
+        if page['status'] not in CACHEABLE_STATUSES:
+            chain['error'] = PlacesApiError(f"Nearby search returned {page['status']}")
+            return True
+        return accept(index, page, live=True)
+
+    def result(index):
+        finished.add(index)
+        first_pending.discard(index)
+        chain = chains[index]
+        if place_index is not None:
+            # Capped, truncated or failed queries add their places but not their area
+            complete = (
+                'error' not in chain and not chain.get('truncated')
+                and not is_saturated(chain['results'], fetch_all_pages)
+            )
+            place_index.record(queries[index], chain['results'], complete)
+        # A failed later page still leaves the earlier pages usable
+        error = chain.get('error') if not chain['collected'] else None
+        end_query_span(
+            index, result_count=len(chain['results']), pages=chain['collected'],
+            **({'status': 'ERROR', 'error': repr(chain['error'])} if 'error' in chain else {})
+        )
+        return index, chain['results'], error, True
+
+    def pages():
+        while arrived:
+            index, results = arrived.popleft()
+            yield index, results, None, False
+
+    workers = min(max_workers or MAX_CONCURRENT_REQUESTS, len(queries))
+    executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        while ready or waiting or running:
+            now = time.monotonic()
+            if now >= stop_at:
+                break
+            while waiting and waiting[0][0] <= now:
+                ready.append(heapq.heappop(waiting)[1])
+            while ready:
+                index = ready.popleft()
+                done = step(index)
+                yield from pages()
+                if done:
+                    yield result(index)
+            if not running:
+                if waiting:
+                    time.sleep(max(0, min(waiting[0][0], stop_at) - time.monotonic()))
+                continue
+            timeout = stop_at - now
+            if waiting:
+                timeout = min(timeout, waiting[0][0] - now)
+            done, _ = wait(running, timeout=max(0, timeout), return_when=FIRST_COMPLETED)
+            for future in done:
+                index = running.pop(future)
+                done = handle(index, future)
+                yield from pages()
+                if done:
+                    yield result(index)
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+        for page_span in page_spans.values():
+            page_span.end(status='CANCELLED')
+
+    # Whatever is left ran out of time; hand back the pages that did arrive
+    for index in range(len(queries)):
+        if index not in finished:
+            chains[index].setdefault('error', PlacesApiError("Search deadline exceeded"))
+            yield result(index)
+
+
+def fetch_nearby_places(location, radius=2500, place_type='restaurant', fetch_all_pages=False):
+    # Yield a single query's pages as they arrive; raises PlacesApiError if
+    # it fails before any page came back
+    queries = [(location, radius, place_type)]
+    for _, results, error, done in iter_search_pages(queries, fetch_all_pages, max_workers=1):
+        if error is not None:
+            raise error
+        if done:
+            return
+        yield results
+
+
+def compact_place(place, category):
+    # Copy just what the map and lists read (coalesced requests share the
+    # raw result dicts across sessions, so they are never modified)
+    compact = {field: place[field] for field in PLACE_FIELDS if field in place}
+    if 'geometry' in place and 'location' in place['geometry']:
+        compact['geometry'] = {'location': place['geometry']['location']}
+    compact['category'] = category
+    compact['categories'] = [category]
+    return compact
+
+
+def merge_place(places_by_id, result, category):
+    # Add a raw result to {place_id: compact place}; a place found again
+    # (another category or grid cell) gains the category instead of being
+    # added twice. Returns the compact place when it is new.
+    place_id = result.get('place_id')
+    place = places_by_id.get(place_id)
+    if place is None:
+        place = places_by_id[place_id] = compact_place(result, category)
+        return place
+    if category not in place['categories']:
+        place['categories'].append(category)
+    return None
+
+
+def dedupe_places(queries, results_per_query):
+    # One record per place_id with every category it was found under. The
+    # first occurrence in query order gives the primary category, so the
+    # outcome does not depend on which request happened to finish first.
+    places_by_id = {}
+    for (_, _, place_type), results in zip(queries, results_per_query):
+        for result in results or []:
+            merge_place(places_by_id, result, place_type)
+    return list(places_by_id.values())
+
+
+class RunningResults:
+    # Places of a search that is still running, merged in arrival order,
+    # with the most reviewed ones so far kept aside for highlighting
+    def __init__(self, top_count=3):
+        self.places = []
+        self.top = []
+        self.top_count = top_count
+        self._places_by_id = {}
+
+    def add(self, results, category):
+        # Add a page of raw results; returns the places not seen before
+        added = []
+        for result in results:
+            place = merge_place(self._places_by_id, result, category)
+            if place is not None:
+                added.append(place)
+        if added:
+            self.places.extend(added)
+            self.top = heapq.nlargest(
+                self.top_count, self.top + added,
+                key=lambda place: place.get('user_ratings_total', 0)
+            )
+        return added
+
+
+def run_queries(queries, fetch_all_pages=False, max_workers=None, place_index=None,
+                on_page=None, on_progress=None, budget=None):
+    # Fan out all queries concurrently and return (results per query, errors).
+    # on_page(query, page results) and on_progress(done, total) are called
+    # from the caller's thread.
+    results_per_query = [[] for _ in queries]
+    errors = []
+    finished = 0
+    for index, results, error, done in iter_search_pages(
+            queries, fetch_all_pages, max_workers, place_index=place_index, budget=budget):
+        if not done:
+            if on_page:
+                on_page(queries[index], results)
+            continue
+        finished += 1
+        results_per_query[index] = results
+        if error is not None:
+            errors.append(error)
+        if on_progress:
+            on_progress(finished, len(queries))
+    return results_per_query, errors
+
+
+def run_search(queries, fetch_all_pages=False, max_workers=None, on_progress=None,
+               place_index=None, on_page=None, budget=None):
+    # Run all queries and return (deduped places, errors)
+    results_per_query, errors = run_queries(
+        queries, fetch_all_pages, max_workers, place_index, on_page, on_progress, budget)
+    return dedupe_places(queries, results_per_query), errors
+
+
+def is_saturated(results, fetch_all_pages=False):
+    # A query that filled every page it was allowed to fetch probably had
+    # more places than the API was willing to return
+    return len(results) >= PAGE_SIZE * (MAX_PAGES if fetch_all_pages else 1)
+
+
+def split_cell(center, radius):
+    # The four quadrants of the circle's bounding square, each covered by its
+    # circumscribed circle, so the children cover the whole parent circle
+    half = radius / 2
+    child_radius = radius / math.sqrt(2)
+    return [
+        (offset_point(center, north, east), child_radius)
+        for north in (half, -half)
+        for east in (-half, half)
+    ]
+
+
+def run_adaptive_search(center, radius, place_types, fetch_all_pages=False,
+                        min_radius=ADAPTIVE_MIN_RADIUS, max_calls=ADAPTIVE_MAX_CALLS,
+                        max_workers=None, place_index=None, on_page=None, budget=None):
+    # Quadtree search: query the whole circle, then split only the cells whose
+    # query came back saturated, one level at a time, until the cells reach
+    # min_radius or max_calls upstream requests have been spent. Every level
+    # runs under one CallBudget (the given one, whose limit then replaces
+    # max_calls), so later pages and token retries count too; cells and
+    # queries left out for lack of calls are counted on it.
+    # Returns (deduped places, errors, search tree nodes).
+    tree = []
+    all_queries = []
+    all_results = []
+    errors = []
+    if budget is None:
+        budget = CallBudget(max_calls)
+    search_span = tracing.start_span('adaptive_search', radius=radius, max_calls=budget.limit)
+
+    # Each pending cell is (center, radius, depth, parent index, place types)
+    pending = [(list(center), radius, 0, None, list(place_types))]
+    while pending:
+        queries = []
+        query_nodes = []
+        remote = 0  # admitted queries the place index cannot answer
+        for cell_center, cell_radius, depth, parent, cell_types in pending:
+            node = {
+                'center': cell_center,
+                'radius': cell_radius,
+                'depth': depth,
+                'parent': parent,
+                'place_types': [],
+                'saturated_types': [],
+                'result_count': 0,
+            }
+            for place_type in cell_types:
+                query = (f"{cell_center[0]},{cell_center[1]}", round(cell_radius), place_type)
+                # Every admitted query can at least fetch its first page;
+                # queries answered from the index cost no calls
+                local = place_index is not None and place_index.covers(query)
+                if not local and budget.spent + remote >= budget.limit:
+                    break
+                remote += not local
+                queries.append(query)
+                query_nodes.append(len(tree))
+                node['place_types'].append(place_type)
+            budget.queries_dropped += len(cell_types) - len(node['place_types'])
+            if node['place_types']:
+                tree.append(node)
+            else:
+                budget.cells_dropped += 1
+        if not queries:
+            break
+
+        level_span = tracing.start_span('level', search_span, depth=pending[0][2], queries=len(queries))
+        results_per_query, level_errors = tracing.run_in_span(
+            level_span, run_queries, queries, fetch_all_pages, max_workers, place_index, on_page,
+            budget=budget)
+        level_span.end()
+        errors.extend(level_errors)
+        all_queries.extend(queries)
+        all_results.extend(results_per_query)
+
+        pending = []
+        saturated_cells = {}
+        for (_, _, place_type), results, node_index in zip(queries, results_per_query, query_nodes):
+            node = tree[node_index]
+            node['result_count'] += len(results)
+            if is_saturated(results, fetch_all_pages):
+                node['saturated_types'].append(place_type)
+                saturated_cells.setdefault(node_index, []).append(place_type)
+        for node_index, saturated_types in saturated_cells.items():
+            node = tree[node_index]
+            if node['radius'] / math.sqrt(2) < min_radius:
+                continue
+            for child_center, child_radius in split_cell(node['center'], node['radius']):
+                pending.append((child_center, child_radius, node['depth'] + 1, node_index, saturated_types))
+
+    search_span.end(calls=budget.spent, cells=len(tree))
+    return dedupe_places(all_queries, all_results), errors, tree
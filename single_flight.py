@@ -0,0 +1,58 @@
+import threading
+
+import tracing
+
+
+class SingleFlight:
+    # Coalesces concurrent calls that share a key: the first caller runs the
+    # function, everyone who arrives while it is in flight waits for it and
+    # gets the same result (or exception). Nothing is kept once it returns.
+    # If the first caller is interrupted (KeyboardInterrupt, SystemExit and
+    # other BaseExceptions), the waiting callers run the call themselves.
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._in_flight = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    def do(self, key, fn, *args, **kwargs):
+        with self._lock:
+            call = self._in_flight.get(key)
+            leader = call is None
+            if leader:
+                call = {'done': threading.Event(), 'finished': False, 'result': None, 'error': None}
+                self._in_flight[key] = call
+                self.calls += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            tracing.annotate(coalesced=True)
+            call['done'].wait()
+            if not call['finished']:
+                return self.do(key, fn, *args, **kwargs)
+            if call['error'] is not None:
+                raise call['error']
+            return call['result']
+
+        try:
+            call['result'] = fn(*args, **kwargs)
+            call['finished'] = True
+        except Exception as error:
+            call['error'] = error
+            call['finished'] = True
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+            call['done'].set()
+        return call['result']
+
+    def stats(self):
+        requests = self.calls + self.coalesced
+        return {
+            'calls': self.calls,
+            'coalesced': self.coalesced,
+            'coalesce_rate': self.coalesced / requests if requests else 0.0,
+        }
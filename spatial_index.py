@@ -0,0 +1,284 @@
+import math
+import os
+import threading
+import time
+from collections import deque
+
+from search import METERS_PER_DEGREE
+
+# Places are bucketed on a lat/lng grid with cells this many degrees wide (~280 m)
+INDEX_CELL_DEGREES = 0.0025
+# Fetched places and the areas known to be complete expire after this many seconds
+INDEX_TTL = int(os.getenv('PLACES_INDEX_TTL', str(24 * 60 * 60)))
+# Above this many places the oldest ones (and their coverage) are dropped
+INDEX_MAX_PLACES = int(os.getenv('PLACES_INDEX_MAX_PLACES', '50000'))
+# Complete areas are bucketed on a coarser grid (~5.5 km), under every cell
+# their bounding box touches
+COVERAGE_CELL_DEGREES = 0.05
+# Slack in meters for float error when comparing points with circle edges
+COVERAGE_TOLERANCE = 1e-6
+
+
+def distance(lat1, lng1, lat2, lng2):
+    # Equirectangular distance in meters, plenty for search-radius scales
+    x = (lng2 - lng1) * math.cos(math.radians((lat1 + lat2) / 2))
+    y = lat2 - lat1
+    return math.hypot(x, y) * METERS_PER_DEGREE
+
+
+def parse_location(location):
+    lat, lng = (float(value) for value in str(location).split(','))
+    return lat, lng
+
+
+def _circle_intersections(a, b):
+    # Angles on circle a = (x, y, r) where its edge crosses circle b's edge
+    dx, dy = b[0] - a[0], b[1] - a[1]
+    d = math.hypot(dx, dy)
+    if d == 0 or d >= a[2] + b[2] or d <= abs(a[2] - b[2]):
+        return []
+    base = math.atan2(dy, dx)
+    spread = math.acos(max(-1.0, min(1.0, (a[2] ** 2 - b[2] ** 2 + d ** 2) / (2 * d * a[2]))))
+    return [base - spread, base + spread]
+
+
+def _arc_midpoints(circle, angles):
+    # One point on each arc of the circle's edge between the given angles
+    x, y, r = circle
+    if not angles:
+        angles = [0.0]
+    angles = sorted(angle % (2 * math.pi) for angle in angles)
+    for start, stop in zip(angles, angles[1:] + [angles[0] + 2 * math.pi]):
+        middle = (start + stop) / 2
+        yield x + r * math.cos(middle), y + r * math.sin(middle)
+
+
+def circle_covered(query, circles):
+    # Exact test that the query circle lies inside the union of the circles
+    # (all (x, y, r) in meters on one plane). The uncovered part of the
+    # query, if any, is bounded by arcs of the query's edge or of a circle's
+    # edge inside the query that no other circle covers, and each arc is
+    # either all covered or all not, so one point per arc decides.
+    tolerance = COVERAGE_TOLERANCE
+    circles = list(dict.fromkeys(circles))
+    qx, qy, qr = query
+    if any(math.hypot(x - qx, y - qy) + qr <= r + tolerance for x, y, r in circles):
+        return True
+    # The query's edge: every arc between crossings must be inside a circle
+    crossings = [angle for circle in circles for angle in _circle_intersections(query, circle)]
+    for px, py in _arc_midpoints(query, crossings):
+        if not any(math.hypot(px - x, py - y) <= r + tolerance for x, y, r in circles):
+            return False
+    # Every circle's edge inside the query must be inside another circle
+    for i, circle in enumerate(circles):
+        neighbours = [
+            other for j, other in enumerate(circles)
+            if j != i and math.hypot(other[0] - circle[0], other[1] - circle[1]) < other[2] + circle[2]
+        ]
+        angles = _circle_intersections(circle, query)
+        for other in neighbours:
+            angles.extend(_circle_intersections(circle, other))
+        for px, py in _arc_midpoints(circle, angles):
+            if math.hypot(px - qx, py - qy) >= qr - tolerance:
+                continue
+            if not any(math.hypot(px - x, py - y) < r - tolerance for x, y, r in neighbours):
+                return False
+    return True
+
+
+class PlaceIndex:
+    # Grid-bucketed index of every place fetched so far, plus a record of
+    # which (circle, type) queries came back complete, i.e. not capped by
+    # the API. A query whose circle is covered by complete queries of the
+    # same type can be answered locally without calling the Places API.
+
+    def __init__(self, ttl=INDEX_TTL, max_places=INDEX_MAX_PLACES):
+        self.ttl = ttl
+        self.max_places = max_places
+        self.local_queries = 0
+        self.remote_queries = 0
+        self._lock = threading.Lock()
+        self._places = {}    # place_id -> (place, seen_at)
+        self._cells = {}     # grid cell -> set of place_ids
+        # place type -> coverage cell -> [(lat, lng, radius, recorded_at)]
+        self._coverage = {}
+        # (place type, record) in recording order, so expired ones go first
+        self._coverage_log = deque()
+
+    def _cell(self, lat, lng):
+        return (math.floor(lat / INDEX_CELL_DEGREES), math.floor(lng / INDEX_CELL_DEGREES))
+
+    def _coverage_cells(self, lat, lng, radius):
+        # Coverage cells touched by a circle's bounding box
+        lat_span = radius / METERS_PER_DEGREE
+        lng_span = radius / (METERS_PER_DEGREE * max(math.cos(math.radians(lat)), 1e-6))
+        rows = range(math.floor((lat - lat_span) / COVERAGE_CELL_DEGREES),
+                     math.floor((lat + lat_span) / COVERAGE_CELL_DEGREES) + 1)
+        cols = range(math.floor((lng - lng_span) / COVERAGE_CELL_DEGREES),
+                     math.floor((lng + lng_span) / COVERAGE_CELL_DEGREES) + 1)
+        return [(row, col) for row in rows for col in cols]
+
+    def _add_coverage(self, place_type, record):
+        cells = self._coverage.setdefault(place_type, {})
+        for cell in self._coverage_cells(*record[:3]):
+            cells.setdefault(cell, []).append(record)
+        self._coverage_log.append((place_type, record))
+
+    def _expire_coverage(self, cutoff):
+        # Drop the complete areas recorded before cutoff
+        while self._coverage_log and self._coverage_log[0][1][3] < cutoff:
+            place_type, record = self._coverage_log.popleft()
+            cells = self._coverage[place_type]
+            for cell in self._coverage_cells(*record[:3]):
+                cells[cell].remove(record)
+                if not cells[cell]:
+                    del cells[cell]
+
+    def record(self, query, results, complete):
+        # Add a finished query's places; complete=False when the API capped
+        # the results (or the query failed part way), so the area still
+        # needs upstream calls later
+        location, radius, place_type = query
+        lat, lng = parse_location(location)
+        now = time.time()
+        with self._lock:
+            self.remote_queries += 1
+            self._expire_coverage(now - self.ttl)
+            for place in results:
+                place_location = place.get('geometry', {}).get('location')
+                if not place_location or not place.get('place_id'):
+                    continue
+                place_id = place['place_id']
+                if place_id not in self._places:
+                    cell = self._cell(place_location['lat'], place_location['lng'])
+                    self._cells.setdefault(cell, set()).add(place_id)
+                self._places[place_id] = (place, now)
+            if complete:
+                self._add_coverage(place_type, (lat, lng, radius, now))
+            if len(self._places) > self.max_places:
+                self._prune()
+
+    def _prune(self):
+        # Keep the newest 90% of the cap; coverage recorded before the
+        # cutoff may refer to dropped places, so it goes too
+        seen = sorted(seen_at for _, seen_at in self._places.values())
+        cutoff = max(seen[len(seen) - int(self.max_places * 0.9)], time.time() - self.ttl)
+        for place_id, (place, seen_at) in list(self._places.items()):
+            if seen_at < cutoff:
+                del self._places[place_id]
+                location = place['geometry']['location']
+                self._cells[self._cell(location['lat'], location['lng'])].discard(place_id)
+        self._expire_coverage(cutoff)
+
+    def covers(self, query):
+        # True when the query circle lies inside the union of fresh complete
+        # queries of the same type (only those near it are looked at)
+        location, radius, place_type = query
+        lat, lng = parse_location(location)
+        with self._lock:
+            self._expire_coverage(time.time() - self.ttl)
+            cells = self._coverage.get(place_type, {})
+            nearby = dict.fromkeys(
+                record
+                for cell in self._coverage_cells(lat, lng, radius)
+                for record in cells.get(cell, ())
+            )
+        records = [
+            record for record in nearby
+            if distance(lat, lng, record[0], record[1]) < radius + record[2]
+        ]
+        if not records:
+            return False
+        # Records on a plane in meters around the query's center
+        lng_scale = METERS_PER_DEGREE * math.cos(math.radians(lat))
+        circles = [
+            ((r_lng - lng) * lng_scale, (r_lat - lat) * METERS_PER_DEGREE, r_radius)
+            for r_lat, r_lng, r_radius, _ in records
+        ]
+        return circle_covered((0.0, 0.0, radius), circles)
+
+    def query(self, center, radius, place_type=None, k=None):
+        # Places within radius of center (of place_type, if given), most
+        # reviewed first, at most k of them
+        lat, lng = center
+        lat_span = radius / METERS_PER_DEGREE
+        lng_span = radius / (METERS_PER_DEGREE * math.cos(math.radians(lat)))
+        min_cell = self._cell(lat - lat_span, lng - lng_span)
+        max_cell = self._cell(lat + lat_span, lng + lng_span)
+        oldest = time.time() - self.ttl
+        with self._lock:
+            cell_count = (max_cell[0] - min_cell[0] + 1) * (max_cell[1] - min_cell[1] + 1)
+            if cell_count > len(self._places):
+                candidates = list(self._places)
+            else:
+                candidates = [
+                    place_id
+                    for row in range(min_cell[0], max_cell[0] + 1)
+                    for col in range(min_cell[1], max_cell[1] + 1)
+                    for place_id in self._cells.get((row, col), ())
+                ]
+            matches = []
+            for place_id in candidates:
+                place, seen_at = self._places[place_id]
+                if seen_at < oldest:
+                    continue
+                if place_type is not None and place_type not in place.get('types', [place.get('category')]):
+                    continue
+                location = place['geometry']['location']
+                if distance(lat, lng, location['lat'], location['lng']) <= radius:
+                    matches.append(place)
+        matches.sort(key=lambda place: place.get('user_ratings_total', 0), reverse=True)
+        return matches[:k] if k is not None else matches
+
+    def lookup(self, query, k=None):
+        # Local answer for a (location, radius, place type) query, at most k
+        # places (most reviewed first)
+        location, radius, place_type = query
+        with self._lock:
+            self.local_queries += 1
+        return self.query(parse_location(location), radius, place_type, k)
+
+    def split_queries(self, queries):
+        # (queries answerable locally, queries that still need the Places API)
+        local, remote = [], []
+        for query in queries:
+            (local if self.covers(query) else remote).append(query)
+        return local, remote
+
+    def snapshot(self):
+        # Plain copy of the places and coverage, for the warm-start snapshot
+        with self._lock:
+            return {
+                'places': dict(self._places),
+                'coverage': {
+                    place_type: list(dict.fromkeys(record for records in cells.values() for record in records))
+                    for place_type, cells in self._coverage.items()
+                },
+            }
+
+    def restore(self, state):
+        # Load a snapshot, keeping only what has not expired since it was taken
+        oldest = time.time() - self.ttl
+        with self._lock:
+            for place_id, (place, seen_at) in state['places'].items():
+                if seen_at < oldest or place_id in self._places:
+                    continue
+                location = place['geometry']['location']
+                self._cells.setdefault(self._cell(location['lat'], location['lng']), set()).add(place_id)
+                self._places[place_id] = (place, seen_at)
+            for place_type, records in state['coverage'].items():
+                for record in records:
+                    if record[3] >= oldest:
+                        self._add_coverage(place_type, record)
+            self._coverage_log = deque(sorted(self._coverage_log, key=lambda item: item[1][3]))
+            if len(self._places) > self.max_places:
+                self._prune()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'places': len(self._places),
+                'complete_areas': len(self._coverage_log),
+                'local_queries': self.local_queries,
+                'remote_queries': self.remote_queries,
+            }
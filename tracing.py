@@ -0,0 +1,167 @@
+import contextvars
+import itertools
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+# Per-search span trees (search > grid cell > category > page), written as
+# one JSON log line per span when the search's root span ends, and folded
+# into process-wide aggregates for the metrics endpoint.
+
+# Log level of the span lines on the places.trace logger ('' to disable)
+TRACE_LOG_LEVEL = os.getenv('PLACES_TRACE_LOG_LEVEL', 'INFO')
+# Finished traces kept in memory for the debug view
+RECENT_TRACES = 20
+
+logger = logging.getLogger('places.trace')
+if TRACE_LOG_LEVEL:
+    _handler = logging.StreamHandler(sys.stderr)
+    _handler.setFormatter(logging.Formatter('%(message)s'))
+    logger.addHandler(_handler)
+    logger.setLevel(TRACE_LOG_LEVEL.upper())
+    logger.propagate = False
+else:
+    logger.disabled = True
+
+_current = contextvars.ContextVar('current_span', default=None)
+_ids = itertools.count(1)
+_lock = threading.Lock()
+_recent = deque(maxlen=RECENT_TRACES)
+# (span name, status) -> [count, total seconds]
+_span_totals = {}
+# Summed numeric span attributes, e.g. bytes and result_count per span name
+_attribute_totals = {}
+_cache_hits = {}
+
+
+class Span:
+    # One timed step of a search. Attributes are plain JSON values; children
+    # are appended from whichever thread creates them.
+
+    def __init__(self, name, parent=None, **attributes):
+        self.name = name
+        self.span_id = next(_ids)
+        self.parent = parent
+        self.trace_id = parent.trace_id if parent else self.span_id
+        self.attributes = attributes
+        self.children = []
+        self.started = time.time()
+        self._started = time.perf_counter()
+        self.seconds = None
+        if parent is not None:
+            with _lock:
+                parent.children.append(self)
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def end(self, **attributes):
+        if self.seconds is not None:
+            return
+        self.attributes.update(attributes)
+        self.seconds = time.perf_counter() - self._started
+        _aggregate(self)
+        if self.parent is None:
+            _finish_trace(self)
+
+    def walk(self, depth=0):
+        # (depth, span) for this span and its descendants, depth first
+        yield depth, self
+        for child in list(self.children):
+            yield from child.walk(depth + 1)
+
+    def to_record(self):
+        return {
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent.span_id if self.parent else None,
+            'name': self.name,
+            'start': self.started,
+            'seconds': self.seconds,
+            **self.attributes,
+        }
+
+
+def _aggregate(span):
+    status = str(span.attributes.get('status', 'OK' if 'error' not in span.attributes else 'ERROR'))
+    with _lock:
+        totals = _span_totals.setdefault((span.name, status), [0, 0.0])
+        totals[0] += 1
+        totals[1] += span.seconds
+        for name in ('bytes', 'result_count', 'retries'):
+            value = span.attributes.get(name)
+            if isinstance(value, (int, float)):
+                key = (span.name, name)
+                _attribute_totals[key] = _attribute_totals.get(key, 0) + value
+        if 'cache_hit' in span.attributes:
+            key = (span.name, bool(span.attributes['cache_hit']))
+            _cache_hits[key] = _cache_hits.get(key, 0) + 1
+
+
+def _finish_trace(root):
+    with _lock:
+        _recent.append(root)
+    if logger.isEnabledFor(logging.INFO):
+        for _, span in root.walk():
+            logger.info(json.dumps(span.to_record(), default=str))
+
+
+def current_span():
+    return _current.get()
+
+
+def start_span(name, parent=None, **attributes):
+    # A span under `parent`, or under the current span when parent is None
+    return Span(name, parent if parent is not None else _current.get(), **attributes)
+
+
+@contextmanager
+def span(name, **attributes):
+    # Run a block as the current span; an exception is recorded and re-raised
+    current = start_span(name, **attributes)
+    token = _current.set(current)
+    try:
+        yield current
+    except Exception as error:
+        current.set(error=repr(error))
+        raise
+    finally:
+        _current.reset(token)
+        current.end()
+
+
+def annotate(**attributes):
+    # Add attributes to the current span, if there is one
+    current = _current.get()
+    if current is not None:
+        current.set(**attributes)
+
+
+def run_in_span(current, fn, *args, **kwargs):
+    # Call fn with `current` as the current span, e.g. on a pool thread
+    token = _current.set(current)
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        _current.reset(token)
+
+
+def recent_traces():
+    with _lock:
+        return list(_recent)
+
+
+def span_totals():
+    # {(span name, status): (count, total seconds)}, {(span name, attribute): sum},
+    # {(span name, cache hit): count}
+    with _lock:
+        return (
+            {key: tuple(value) for key, value in _span_totals.items()},
+            dict(_attribute_totals),
+            dict(_cache_hits),
+        )
@@ -0,0 +1,139 @@
+import atexit
+import importlib
+import json
+import os
+import pickle
+import threading
+import time
+
+import tracing
+from places_cache import CACHE_PATH
+from refresher import nearby_refresher
+
+# Cold-start support for scale-to-zero deployments: the map stack is
+# imported in the background while the first page renders, the in-memory
+# search state is saved to and restored from the mounted volume, and the
+# time from process start to the first rendered map is recorded.
+
+# Where the warm-start snapshot lives (next to the response cache by
+# default; an empty string disables it)
+SNAPSHOT_PATH = os.getenv(
+    'PLACES_SNAPSHOT_PATH',
+    os.path.join(os.path.dirname(CACHE_PATH), 'places_snapshot.pickle') if CACHE_PATH else '',
+)
+# Seconds between two snapshots while the app runs (one more is written at exit)
+SNAPSHOT_INTERVAL = float(os.getenv('PLACES_SNAPSHOT_INTERVAL', '300'))
+SNAPSHOT_VERSION = 1
+# Imported off the main thread, slowest first (folium alone is most of it)
+MAP_MODULES = ['folium', 'folium.plugins', 'streamlit_folium', 'streamlit_geolocation']
+
+_lock = threading.Lock()
+_startup = {}  # phase -> seconds
+
+
+def process_uptime():
+    # Seconds since this process started (from /proc), or None elsewhere
+    try:
+        with open('/proc/self/stat') as f:
+            started_ticks = int(f.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+    except (OSError, ValueError, IndexError):
+        return None
+    return max(0.0, uptime - started_ticks / os.sysconf('SC_CLK_TCK'))
+
+
+def record_startup(phase, seconds):
+    # Keep the first measurement of a startup phase
+    if seconds is None:
+        return
+    with _lock:
+        _startup.setdefault(phase, seconds)
+
+
+def startup_stats():
+    with _lock:
+        return dict(_startup)
+
+
+def preload_map_stack():
+    # Import the map modules from a daemon thread; the app's own imports
+    # then find them loaded, or wait for the thread instead of starting over
+    def preload():
+        started = time.perf_counter()
+        for name in MAP_MODULES:
+            importlib.import_module(name)
+        record_startup('map_imports', time.perf_counter() - started)
+
+    record_startup('first_script', process_uptime())
+    thread = threading.Thread(target=preload, name='map-preload', daemon=True)
+    thread.start()
+    return thread
+
+
+def first_map_rendered():
+    # Called after a map is handed to the browser; the first call of the
+    # process closes the cold start and logs it
+    with _lock:
+        if 'first_map' in _startup:
+            return
+    record_startup('first_map', process_uptime())
+    tracing.logger.info(json.dumps({'name': 'startup', **startup_stats()}))
+
+
+def save_snapshot(place_index, path=SNAPSHOT_PATH):
+    # Written under a temporary name and renamed, so a machine stopped
+    # mid-write keeps the previous snapshot
+    state = {
+        'version': SNAPSHOT_VERSION,
+        'saved_at': time.time(),
+        'place_index': place_index.snapshot(),
+        'refresher': nearby_refresher.snapshot(),
+    }
+    temporary = f"{path}.tmp"
+    with open(temporary, 'wb') as f:
+        pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temporary, path)
+
+
+def load_snapshot(place_index, path=SNAPSHOT_PATH):
+    # Restore a snapshot into the index and the refresher; returns the
+    # number of places restored (0 without a usable snapshot)
+    started = time.perf_counter()
+    try:
+        with open(path, 'rb') as f:
+            state = pickle.load(f)
+    except FileNotFoundError:
+        return 0
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError):
+        tracing.logger.warning(f"Ignoring unreadable warm-start snapshot {path}")
+        return 0
+    if state.get('version') != SNAPSHOT_VERSION:
+        return 0
+    place_index.restore(state['place_index'])
+    nearby_refresher.restore(state['refresher'])
+    record_startup('snapshot_restore', time.perf_counter() - started)
+    return place_index.stats()['places']
+
+
+def keep_snapshots(place_index, path=SNAPSHOT_PATH, interval=SNAPSHOT_INTERVAL):
+    # Restore the last snapshot, then save one every `interval` seconds and
+    # at exit (auto-stopped machines get SIGINT, which exits cleanly)
+    if not path:
+        return 0
+    restored = load_snapshot(place_index, path)
+    stopped = threading.Event()
+
+    def save():
+        try:
+            save_snapshot(place_index, path)
+        except OSError as error:
+            tracing.logger.warning(f"Could not write warm-start snapshot {path}: {error}")
+
+    def run():
+        while not stopped.wait(interval):
+            save()
+
+    threading.Thread(target=run, name='snapshots', daemon=True).start()
+    atexit.register(lambda: (stopped.set(), save()))
+    return restored